@@ -0,0 +1,46 @@
+"""inventory quantity
+
+Revision ID: 3f1c2d7e9b40
+Revises: a94c4af95141
+Create Date: 2026-10-18 10:12:41.503218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2d7e9b40'
+down_revision = 'a94c4af95141'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('inventory', sa.Column('quantity', sa.Integer(), server_default='1', nullable=False))
+    # Compact one row per purchase into one row per (user, item)
+    op.execute("""
+        UPDATE inventory AS i
+        SET quantity = agg.total
+        FROM (
+            SELECT min(id) AS id, count(*) AS total
+            FROM inventory
+            GROUP BY user_id, merchandise_id
+        ) AS agg
+        WHERE i.id = agg.id
+    """)
+    op.execute("""
+        DELETE FROM inventory
+        WHERE id NOT IN (SELECT min(id) FROM inventory GROUP BY user_id, merchandise_id)
+    """)
+    op.create_unique_constraint('uq_inventory_user_merchandise', 'inventory', ['user_id', 'merchandise_id'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_inventory_user_merchandise', 'inventory', type_='unique')
+    op.execute("""
+        INSERT INTO inventory (user_id, merchandise_id)
+        SELECT user_id, merchandise_id
+        FROM inventory, generate_series(2, quantity)
+    """)
+    op.drop_column('inventory', 'quantity')
@@ -0,0 +1,44 @@
+"""history indexes
+
+Revision ID: 8d2e5a1c7f63
+Revises: 3f1c2d7e9b40
+Create Date: 2026-10-18 11:04:17.882051
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e5a1c7f63'
+down_revision = '3f1c2d7e9b40'
+branch_labels = None
+depends_on = None
+
+# Standalone indexes on primary keys, duplicating the pkey index
+PK_INDEXES = [
+    ('ix_users_id', 'users'),
+    ('ix_merchandise_id', 'merchandise'),
+    ('ix_inventory_id', 'inventory'),
+    ('ix_transactions_id', 'transactions'),
+]
+
+
+def upgrade() -> None:
+    # CONCURRENTLY can't run inside a transaction block.
+    # inventory.user_id is already served by uq_inventory_user_merchandise.
+    with op.get_context().autocommit_block():
+        op.create_index('ix_transactions_to_user_id_id', 'transactions', ['to_user_id', 'id'],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index('ix_transactions_from_user_id_id', 'transactions', ['from_user_id', 'id'],
+                        unique=False, postgresql_concurrently=True)
+        for index_name, table_name in PK_INDEXES:
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for index_name, table_name in PK_INDEXES:
+            op.create_index(index_name, table_name, ['id'], unique=False, postgresql_concurrently=True)
+        op.drop_index('ix_transactions_from_user_id_id', table_name='transactions', postgresql_concurrently=True)
+        op.drop_index('ix_transactions_to_user_id_id', table_name='transactions', postgresql_concurrently=True)
@@ -0,0 +1,34 @@
+"""transfer summary
+
+Revision ID: 9a4f6c1e8b27
+Revises: e5b7d3a9c2f1
+Create Date: 2026-10-18 18:15:37.402261
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4f6c1e8b27'
+down_revision = 'e5b7d3a9c2f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Filled by `python -m app.summary backfill` after the upgrade
+    op.create_table('transfer_summary',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('counterparty_id', sa.Integer(), nullable=False),
+    sa.Column('direction', sa.String(), nullable=False),
+    sa.Column('total', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['counterparty_id'], ['users.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'counterparty_id', 'direction')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('transfer_summary')
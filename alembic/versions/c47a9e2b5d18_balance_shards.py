@@ -0,0 +1,39 @@
+"""balance shards
+
+Revision ID: c47a9e2b5d18
+Revises: 8d2e5a1c7f63
+Create Date: 2026-10-18 13:26:50.114937
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47a9e2b5d18'
+down_revision = '8d2e5a1c7f63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('balance_shards', sa.Integer(), server_default='0', nullable=False))
+    op.create_table('balance_shards',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('coins', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'shard')
+    )
+
+
+def downgrade() -> None:
+    # Fold shard balances back into the owning accounts first
+    op.execute("""
+        UPDATE users AS u
+        SET coins = u.coins + s.total
+        FROM (SELECT user_id, sum(coins) AS total FROM balance_shards GROUP BY user_id) AS s
+        WHERE u.id = s.user_id
+    """)
+    op.drop_table('balance_shards')
+    op.drop_column('users', 'balance_shards')
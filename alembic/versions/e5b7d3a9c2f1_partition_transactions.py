@@ -0,0 +1,109 @@
+"""partition transactions by created_at
+
+Revision ID: e5b7d3a9c2f1
+Revises: c47a9e2b5d18
+Create Date: 2026-10-18 16:42:08.530117
+
+"""
+from datetime import datetime, timedelta, timezone
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b7d3a9c2f1'
+down_revision = 'c47a9e2b5d18'
+branch_labels = None
+depends_on = None
+
+PARTITIONS_AHEAD = 3
+
+
+def _next_month(moment):
+    moment = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return (moment + timedelta(days=32)).replace(day=1)
+
+
+def upgrade() -> None:
+    op.add_column('inventory', sa.Column('created_at', sa.DateTime(timezone=True),
+                                         server_default=sa.text('now()'), nullable=False))
+    op.create_table('archived_transfers',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('counterparty_id', sa.Integer(), nullable=False),
+    sa.Column('direction', sa.String(), nullable=False),
+    sa.Column('total', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['counterparty_id'], ['users.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'counterparty_id', 'direction')
+    )
+
+    # The existing table is attached as the partition for everything before
+    # next month instead of being copied. now() is stable, so adding the
+    # column is a metadata-only change; old rows get the migration time.
+    # Rebuilding the primary key and validating the bound still read the
+    # whole table once each.
+    op.execute("ALTER TABLE transactions RENAME TO transactions_legacy")
+    op.execute("ALTER INDEX transactions_pkey RENAME TO transactions_legacy_pkey")
+    op.execute("ALTER INDEX ix_transactions_to_user_id_id RENAME TO transactions_legacy_to_user_id_id_idx")
+    op.execute("ALTER INDEX ix_transactions_from_user_id_id RENAME TO transactions_legacy_from_user_id_id_idx")
+    op.execute("ALTER TABLE transactions_legacy ADD COLUMN created_at timestamptz NOT NULL DEFAULT now()")
+
+    op.execute("""
+        CREATE TABLE transactions (
+            id integer NOT NULL DEFAULT nextval('transactions_id_seq'),
+            from_user_id integer REFERENCES users (id),
+            to_user_id integer REFERENCES users (id),
+            amount integer,
+            created_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id")
+    # Partitioned indexes; the legacy table's identical indexes are attached, not rebuilt
+    op.execute("CREATE INDEX ix_transactions_to_user_id_id ON transactions (to_user_id, id)")
+    op.execute("CREATE INDEX ix_transactions_from_user_id_id ON transactions (from_user_id, id)")
+
+    start = _next_month(datetime.now(timezone.utc))
+    # A partition needs the parent's key, so (id) is replaced by (id, created_at).
+    # The CHECK matches the partition bound, which lets ATTACH skip its own
+    # scan of the table under the exclusive lock; it is redundant afterwards.
+    op.execute("ALTER TABLE transactions_legacy DROP CONSTRAINT transactions_legacy_pkey")
+    op.execute("ALTER TABLE transactions_legacy ADD CONSTRAINT transactions_legacy_pkey "
+               "PRIMARY KEY (id, created_at)")
+    op.execute("ALTER TABLE transactions_legacy ADD CONSTRAINT transactions_legacy_bound "
+               f"CHECK (created_at < '{start.isoformat()}') NOT VALID")
+    op.execute("ALTER TABLE transactions_legacy VALIDATE CONSTRAINT transactions_legacy_bound")
+    op.execute("ALTER TABLE transactions ATTACH PARTITION transactions_legacy "
+               f"FOR VALUES FROM (MINVALUE) TO ('{start.isoformat()}')")
+    op.execute("ALTER TABLE transactions_legacy DROP CONSTRAINT transactions_legacy_bound")
+    for _ in range(PARTITIONS_AHEAD):
+        end = _next_month(start)
+        op.execute(f"CREATE TABLE transactions_p{start:%Y%m} PARTITION OF transactions "
+                   f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+        start = end
+    # Catches rows past the last monthly partition if `python -m app.archive` stops running
+    op.execute("CREATE TABLE transactions_default PARTITION OF transactions DEFAULT")
+
+
+def downgrade() -> None:
+    # Only attached partitions are copied back: archived months stay rolled up
+    op.execute("""
+        CREATE TABLE transactions_plain (
+            id integer NOT NULL DEFAULT nextval('transactions_id_seq') PRIMARY KEY,
+            from_user_id integer REFERENCES users (id),
+            to_user_id integer REFERENCES users (id),
+            amount integer
+        )
+    """)
+    op.execute("INSERT INTO transactions_plain (id, from_user_id, to_user_id, amount) "
+               "SELECT id, from_user_id, to_user_id, amount FROM transactions")
+    op.execute("ALTER SEQUENCE transactions_id_seq OWNED BY transactions_plain.id")
+    op.execute("DROP TABLE transactions")
+    op.execute("ALTER TABLE transactions_plain RENAME TO transactions")
+    op.execute("ALTER INDEX transactions_plain_pkey RENAME TO transactions_pkey")
+    op.create_index('ix_transactions_to_user_id_id', 'transactions', ['to_user_id', 'id'], unique=False)
+    op.create_index('ix_transactions_from_user_id_id', 'transactions', ['from_user_id', 'id'], unique=False)
+
+    op.drop_table('archived_transfers')
+    op.drop_column('inventory', 'created_at')
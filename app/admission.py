@@ -0,0 +1,171 @@
+import math
+import time
+from collections import OrderedDict
+from starlette.responses import JSONResponse
+from . import metrics
+from .auth import principal_cache
+from .config import (
+    ADMISSION_CONTROL, ADMISSION_IP_RATE, ADMISSION_IP_BURST, ADMISSION_USER_RATE, ADMISSION_USER_BURST,
+    ADMISSION_MAX_IN_FLIGHT_READ, ADMISSION_MAX_IN_FLIGHT_WRITE, ADMISSION_MAX_IN_FLIGHT_AUTH,
+    ADMISSION_MAX_KEYS,
+)
+
+# Limiter state is only touched from the worker's event loop, so it needs no locks
+
+AUTH_PATHS = {"/api/auth", "/api/register"}
+
+
+def classify(method: str, path: str):
+    """Route class for a request: auth (bcrypt), write, read, or None for unlimited paths."""
+    if not path.startswith("/api/"):
+        return None
+    if path in AUTH_PATHS:
+        return "auth"
+    if method == "GET" and not path.startswith("/api/buy/"):
+        return "read"
+    return "write"
+
+
+class RateLimiter:
+    """Token buckets keyed by client; the least recently seen keys are dropped past maxsize."""
+
+    def __init__(self, rate: float, burst: float, maxsize: int = ADMISSION_MAX_KEYS):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.maxsize = maxsize
+        self.rejected = 0
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+
+    def acquire(self, key, now: float) -> float:
+        # 0 when a token was taken, otherwise seconds until the next one
+        if self.rate <= 0:
+            return 0.0
+        tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0.0
+        else:
+            wait = (1 - tokens) / self.rate
+            self.rejected += 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ConcurrencyLimit:
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self) -> bool:
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+
+class AdmissionController:
+    def __init__(self, enabled: bool, ip: RateLimiter, user: RateLimiter, limits: dict):
+        self.enabled = enabled
+        self.ip = ip
+        self.user = user
+        self.limits = limits
+
+    def in_flight(self) -> dict:
+        return {(name,): limit.in_flight for name, limit in self.limits.items()}
+
+    def rejected(self) -> dict:
+        samples = {("ip_rate", ""): self.ip.rejected, ("user_rate", ""): self.user.rejected}
+        samples.update({("in_flight", name): limit.rejected for name, limit in self.limits.items()})
+        return samples
+
+
+controller = AdmissionController(
+    enabled=ADMISSION_CONTROL,
+    ip=RateLimiter(ADMISSION_IP_RATE, ADMISSION_IP_BURST),
+    user=RateLimiter(ADMISSION_USER_RATE, ADMISSION_USER_BURST),
+    limits={
+        "read": ConcurrencyLimit(ADMISSION_MAX_IN_FLIGHT_READ),
+        "write": ConcurrencyLimit(ADMISSION_MAX_IN_FLIGHT_WRITE),
+        "auth": ConcurrencyLimit(ADMISSION_MAX_IN_FLIGHT_AUTH),
+    },
+)
+
+metrics.registry.register(metrics.Callback(
+    "admission_in_flight", "Requests being processed per route class", ("route_class",),
+    lambda: controller.in_flight()))
+metrics.registry.register(metrics.Callback(
+    "admission_rejected_total", "Requests shed by admission control", ("reason", "route_class"),
+    lambda: controller.rejected(), kind="counter"))
+
+
+def _user_key(token: str):
+    # A token the app has already verified maps to its user, so logging in
+    # again doesn't open a fresh bucket. Unverified claims can't be trusted
+    # (a forged uid must not drain another user's bucket), so on a cache
+    # miss the raw token is the key until the app has checked it.
+    principal = principal_cache.peek(token)
+    return ("user", principal.id) if principal is not None else ("token", token)
+
+
+def _bearer_token(scope):
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            return token if scheme.lower() == "bearer" and token else None
+    return None
+
+
+class AdmissionMiddleware:
+    """Sheds load before any work is done instead of queueing it.
+
+    429 when the client's IP or token bucket is empty, 503 when the route
+    class already has max_in_flight requests running. Both carry Retry-After.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        admission = controller
+        route_class = classify(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if route_class is None or not admission.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        now = time.monotonic()
+        client = scope.get("client")
+        wait = admission.ip.acquire(client[0] if client else None, now)
+        if not wait:
+            token = _bearer_token(scope)
+            if token is not None:
+                wait = admission.user.acquire(_user_key(token), now)
+        if wait:
+            response = JSONResponse(
+                {"detail": "Too many requests"}, status_code=429,
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+            await response(scope, receive, send)
+            return
+
+        limit = admission.limits[route_class]
+        if not limit.acquire():
+            response = JSONResponse(
+                {"detail": "Server is busy"}, status_code=503, headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release()
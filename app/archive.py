@@ -0,0 +1,152 @@
+"""Ages out old transfers. Run periodically, e.g. daily from cron:
+
+    python -m app.archive [--horizon-days 365] [--drop]
+
+On PostgreSQL `transactions` is partitioned by month of created_at. Every
+partition that ends before the horizon is rolled up into archived_transfers
+and detached in one transaction, so history reads, vacuum and backups only
+deal with the hot months. Detached partitions are kept as plain tables for
+export unless --drop is given. Partitions for the coming months are created
+on each run; rows that went to the DEFAULT partition while the job wasn't
+running are moved into them. On other databases rows older than the horizon are rolled up
+and deleted instead.
+"""
+import argparse
+import re
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import column, table, text
+from sqlalchemy.orm import Session
+from . import crud, models
+from .config import ARCHIVE_HORIZON_DAYS, TRANSACTION_PARTITIONS_AHEAD
+
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+# Created by the migration; catches rows past the last monthly partition
+DEFAULT_PARTITION = "transactions_default"
+
+
+def month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(moment: datetime) -> datetime:
+    return month_start(month_start(moment) + timedelta(days=32))
+
+
+def partition_name(start: datetime) -> str:
+    return f"transactions_p{start:%Y%m}"
+
+
+def _parse_bound(value: str) -> datetime:
+    # pg_get_expr renders '2026-11-01 00:00:00+00' in the session's TimeZone;
+    # fromisoformat before 3.11 wants +00:00. Months are cut in UTC.
+    if re.search(r"[+-]\d\d$", value):
+        value += ":00"
+    return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+
+def partitions(db: Session):
+    """(name, upper bound) of each partition of transactions; None for DEFAULT and MAXVALUE."""
+    rows = db.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'transactions'::regclass"
+    )).all()
+    result = []
+    for name, bound in rows:
+        match = _UPPER_BOUND.search(bound)
+        result.append((name, _parse_bound(match.group(1)) if match else None))
+    return sorted(result, key=lambda item: (item[1] is None, item[1] or datetime.min))
+
+
+def create_partitions(db: Session, months_ahead: int = TRANSACTION_PARTITIONS_AHEAD, now: datetime = None):
+    # Monthly partitions from the last existing bound up to months_ahead past now
+    now = now or datetime.now(timezone.utc)
+    bounds = [upper for _, upper in partitions(db) if upper is not None]
+    start = max(bounds) if bounds else month_start(now)
+    horizon = month_start(now)
+    for _ in range(months_ahead + 1):
+        horizon = next_month(horizon)
+    created = []
+    while start < horizon:
+        end = next_month(start)
+        name = partition_name(start)
+        _create_partition(db, name, start, end)
+        created.append(name)
+        start = end
+    db.commit()
+    return created
+
+
+def _create_partition(db: Session, name: str, start: datetime, end: datetime):
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    in_range = f"created_at >= '{start.isoformat()}' AND created_at < '{end.isoformat()}'"
+    stranded = db.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_range})"
+    )).scalar() if _has_default_partition(db) else False
+    if not stranded:
+        db.execute(text(f"CREATE TABLE {name} PARTITION OF transactions {bounds}"))
+        return
+    # Rows landed in the DEFAULT partition while this job wasn't running; the
+    # new partition can't be created next to them, so they are moved into it
+    db.execute(text(f"ALTER TABLE transactions DETACH PARTITION {DEFAULT_PARTITION}"))
+    db.execute(text(f"CREATE TABLE {name} PARTITION OF transactions {bounds}"))
+    db.execute(text(f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE {in_range}"))
+    db.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_range}"))
+    db.execute(text(f"ALTER TABLE transactions ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+
+
+def _has_default_partition(db: Session) -> bool:
+    return db.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'transactions'::regclass AND c.relname = :name)"
+    ), {"name": DEFAULT_PARTITION}).scalar()
+
+
+def archive(db: Session, horizon_days: int = ARCHIVE_HORIZON_DAYS, drop: bool = False, now: datetime = None):
+    """Rolls up transfers older than the horizon; returns what was archived.
+
+    Processes running the API keep their cached /api/info bodies until the
+    users' next write; totals are unchanged by archiving, only grouping is.
+    """
+    now = now or datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=horizon_days)
+
+    if db.get_bind().dialect.name != "postgresql":
+        old = models.Transaction.created_at < cutoff
+        source = db.query(models.Transaction).filter(old).subquery()
+        crud.roll_up_transfers(db, source)
+        deleted = db.query(models.Transaction).filter(old).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+
+    archived = []
+    for name, upper in partitions(db):
+        if upper is None or upper > cutoff:
+            continue
+        crud.roll_up_transfers(db, table(name, column("from_user_id"), column("to_user_id"), column("amount")))
+        db.execute(text(f"ALTER TABLE transactions DETACH PARTITION {name}"))
+        if drop:
+            db.execute(text(f"DROP TABLE {name}"))
+        db.commit()
+        archived.append(name)
+    return archived
+
+
+def main():
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--horizon-days", type=int, default=ARCHIVE_HORIZON_DAYS)
+    parser.add_argument("--months-ahead", type=int, default=TRANSACTION_PARTITIONS_AHEAD)
+    parser.add_argument("--drop", action="store_true", help="drop archived partitions instead of keeping them detached")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        archived = archive(db, args.horizon_days, args.drop)
+        print(f"archived: {archived}")
+        if db.get_bind().dialect.name == "postgresql":
+            print(f"created: {create_partitions(db, args.months_ahead)}")
+
+
+if __name__ == "__main__":
+    main()
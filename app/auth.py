@@ -1,12 +1,26 @@
+import time
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from passlib.context import CryptContext
-from . import models
-from .config import SECRET_KEY, ALGORITHM
+from typing import NamedTuple
+from . import models, hashing
+from .cache import LRUCache
+from .metrics import auth_latency, current_request
+from .config import SECRET_KEY, ALGORITHM, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, PROFILING, SLOW_REQUEST_MS
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+class Principal(NamedTuple):
+    id: int
+    username: str
+    claims: dict
+
+
+# token -> Principal; entries never outlive the token's exp
+principal_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+# The user is only recorded on the request stats when a profile or the slow
+# request log can show it
+_record_user = PROFILING or bool(SLOW_REQUEST_MS)
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -16,23 +30,43 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with auth_latency.time("jwt_encode"):
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
 def get_current_user(db: Session, token: str):
+    principal = principal_cache.get(token)
+    if principal is None:
+        principal = _decode_principal(db, token)
+    if _record_user:
+        stats = current_request.get()
+        if stats is not None:
+            stats.user = principal.username
+    return principal
+
+
+def _decode_principal(db: Session, token: str):
     credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with auth_latency.time("jwt_decode"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
-        user = db.query(models.User).filter(models.User.username == username).first()
-        if user is None:
-            raise credentials_exception
+        user_id = payload.get("uid")
+        if user_id is None:
+            # Tokens issued before the uid claim was added
+            user_id = db.query(models.User.id).filter(models.User.username == username).scalar()
+            if user_id is None:
+                raise credentials_exception
     except JWTError:
         raise credentials_exception
-    return user
+
+    principal = Principal(id=user_id, username=username, claims=payload)
+    if "exp" in payload:
+        principal_cache.set(token, principal, ttl=payload["exp"] - time.time())
+    return principal
 
 
 def authenticate_user(db: Session, username: str, password: str):
@@ -43,8 +77,8 @@ def authenticate_user(db: Session, username: str, password: str):
 
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return hashing.verify_password(plain_password, hashed_password)
 
 
 def get_password_hash(password: str):
-    return pwd_context.hash(password)
+    return hashing.hash_password(password)
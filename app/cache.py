@@ -0,0 +1,181 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from .config import INFO_CACHE_SIZE, INFO_CACHE_TTL
+
+
+class LRUCache:
+    """Thread-safe LRU cache with optional per-entry expiry (monotonic seconds)."""
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= now:
+                del self._data[key]
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        # Like get(), but leaves the statistics and the LRU order alone
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+            return default
+        return entry[0]
+
+    def set(self, key, value, ttl: float = None):
+        if ttl is None or (self.ttl is not None and self.ttl < ttl):
+            ttl = self.ttl
+        if ttl is not None and ttl <= 0:
+            return
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CacheBackend:
+    """Storage used by VersionedCache.
+
+    The in-process LocalBackend is the default; a shared store (Redis,
+    memcached) only has to provide these operations to be plugged in.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl: float = None):
+        raise NotImplementedError
+
+    def incr(self, key) -> int:
+        # Sets key to a version number no entry can have been stored under
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalBackend(CacheBackend):
+    """Values and versions in two bounded LRUs.
+
+    Versions come from one process-wide counter, so a version that was
+    evicted is replaced by a number nobody stored under, never by an old one.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.values = LRUCache(maxsize, ttl)
+        self.versions = LRUCache(maxsize)
+        self._next_version = itertools.count(1)
+
+    def get(self, key):
+        version = self.versions.get(key)
+        if version is not None:
+            return version
+        return self.values.get(key)
+
+    def set(self, key, value, ttl: float = None):
+        self.values.set(key, value, ttl)
+
+    def incr(self, key) -> int:
+        # next() on itertools.count is atomic under the GIL
+        version = next(self._next_version)
+        self.versions.set(key, version)
+        return version
+
+    def clear(self):
+        self.versions.clear()
+        self.values.clear()
+
+
+class VersionedCache:
+    """Per-user response cache invalidated by bumping the user's version.
+
+    Read the version with lookup() before querying the database and store
+    under that version; a write that commits in between bumps the version,
+    so the possibly stale entry is never served.
+
+    With LocalBackend versions are per process: a write handled by another
+    worker does not invalidate this one's entries. Give the backend a TTL
+    (INFO_CACHE_TTL, set by app.server when it runs several workers) to
+    bound that staleness, or plug in a shared backend.
+    """
+
+    def __init__(self, backend: CacheBackend, prefix: str, enabled: bool = True):
+        self.backend = backend
+        self.prefix = prefix
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _version_key(self, user_id):
+        return f"{self.prefix}:v:{user_id}"
+
+    def lookup(self, user_id, variant=None):
+        if not self.enabled:
+            return None, None
+        version = self.backend.get(self._version_key(user_id))
+        if version is None:
+            # Never written or evicted: start from a version with no entries
+            version = self.backend.incr(self._version_key(user_id))
+        value = self.backend.get(f"{self.prefix}:{user_id}:{version}:{variant}")
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return version, value
+
+    def store(self, user_id, version, value, variant=None, ttl: float = None):
+        if self.enabled and version is not None:
+            self.backend.set(f"{self.prefix}:{user_id}:{version}:{variant}", value, ttl)
+
+    def invalidate(self, *user_ids):
+        if not self.enabled:
+            return
+        for user_id in set(user_ids):
+            self.backend.incr(self._version_key(user_id))
+            self.invalidations += 1
+
+    def clear(self):
+        self.backend.clear()
+
+
+info_cache = VersionedCache(LocalBackend(INFO_CACHE_SIZE, INFO_CACHE_TTL or None), "info", enabled=INFO_CACHE_SIZE > 0)
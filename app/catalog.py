@@ -0,0 +1,71 @@
+import hashlib
+import threading
+import time
+from typing import NamedTuple
+from sqlalchemy.orm import Session
+from . import crud, serialization
+from .config import CATALOG_TTL
+
+
+class CatalogItem(NamedTuple):
+    id: int
+    name: str
+    price: int
+
+
+class MerchandiseCatalog:
+    """Process-wide copy of the merchandise table.
+
+    Reloaded from the database on the next access after bump(), and once the
+    copy is older than ttl seconds so changes made by other workers or by a
+    migration are picked up too. The list endpoint body and its ETag are
+    rendered once per load.
+    """
+
+    def __init__(self, ttl: float = CATALOG_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self.loaded_version = None
+        self.loaded_at = None
+        self.items = {}
+        self.body = b"[]"
+        self.etag = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self) -> bool:
+        if self.loaded_version != self.version:
+            return True
+        return bool(self.ttl) and time.monotonic() - self.loaded_at >= self.ttl
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+
+    def load(self, db: Session):
+        version = self.version
+        self.set_items(crud.get_all_merchandise(db), version)
+
+    def set_items(self, rows, version: int = None):
+        items = {row.name: CatalogItem(row.id, row.name, row.price) for row in rows}
+        body = serialization.dumps(
+            [{"name": item.name, "price": item.price} for item in sorted(items.values())]
+        )
+        with self._lock:
+            self.items = items
+            self.body = body
+            self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            self.loaded_version = self.version if version is None else version
+            self.loaded_at = time.monotonic()
+
+    def get(self, name: str):
+        return self.items.get(name)
+
+    def matches(self, if_none_match: str) -> bool:
+        if not if_none_match or self.etag is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or self.etag in tags or "W/" + self.etag in tags
+
+
+merchandise_catalog = MerchandiseCatalog()
@@ -6,9 +6,107 @@ load_dotenv()
 POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 POSTGRES_DB = os.getenv("POSTGRES_DB")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "db")
 
-DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@db/{POSTGRES_DB}"
+DATABASE_URL = os.getenv(
+    "DATABASE_URL", f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}"
+)
+# Реплика для чтения (/api/info, /api/merchandise, /api/history); по умолчанию - основная БД
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL") or DATABASE_URL
+
+# Пул соединений
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", -1))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Режим для PgBouncer (transaction pooling): без своего пула и без prepared statements
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() in ("1", "true", "yes")
+# Сколько секунд кешировать /api/info, прочитанный с реплики (ограничивает влияние лага)
+READ_REPLICA_CACHE_TTL = float(os.getenv("READ_REPLICA_CACHE_TTL", 1))
+
+# Обработчики работают через AsyncSession (asyncpg) вместо пула потоков
+ASYNC_DB = os.getenv("ASYNC_DB", "false").lower() in ("1", "true", "yes")
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+
+# Кеш проверенных токенов: максимум записей и время жизни записи в секундах
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", 300))
+
+# bcrypt: стоимость хеша, число процессов-воркеров (0 - пул потоков) и глубина очереди
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_DEPTH = int(os.getenv("HASH_QUEUE_DEPTH", 64))
+
+# История переводов: размер страницы по умолчанию, максимум и размер пачки для выгрузки
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 50))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", 500))
+HISTORY_STREAM_BATCH = int(os.getenv("HISTORY_STREAM_BATCH", 1000))
+
+# Через сколько секунд воркер перечитывает каталог товаров (изменения из других воркеров и
+# миграций), 0 - только после изменений в этом процессе
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", 30))
+
+# Кеш ответов /api/info: число записей, 0 - выключен
+INFO_CACHE_SIZE = int(os.getenv("INFO_CACHE_SIZE", 10000))
+# Время жизни записи кеша /api/info в секундах, 0 - без ограничения. Кеш и счетчики версий
+# у каждого процесса свои, поэтому при нескольких воркерах app.server по умолчанию ставит 1
+INFO_CACHE_TTL = float(os.getenv("INFO_CACHE_TTL", 0))
+
+# Максимум получателей в одном пакетном переводе
+TRANSFER_BATCH_MAX_SIZE = int(os.getenv("TRANSFER_BATCH_MAX_SIZE", 10000))
+
+# Групповая фиксация переводов: включение, размер пачки, интервал сброса и лимит очереди
+LEDGER_GROUP_COMMIT = os.getenv("LEDGER_GROUP_COMMIT", "false").lower() in ("1", "true", "yes")
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", 100))
+LEDGER_FLUSH_INTERVAL_MS = float(os.getenv("LEDGER_FLUSH_INTERVAL_MS", 5))
+LEDGER_MAX_PENDING = int(os.getenv("LEDGER_MAX_PENDING", 10000))
+
+# Как часто (в секундах) перечитывать список шардированных счетов
+SHARD_REGISTRY_TTL = float(os.getenv("SHARD_REGISTRY_TTL", 60))
+
+# Порог в миллисекундах, после которого запрос пишется в лог медленных (0 - выключено)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 0))
+
+# Быстрая сериализация ответов /api/info, /api/history и /api/merchandise (orjson, без повторной валидации)
+FAST_JSON = os.getenv("FAST_JSON", "false").lower() in ("1", "true", "yes")
+
+# Запуск через python -m app.server: адрес, порт и число воркеров (0 - по числу CPU)
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", 8080))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 0))
+
+# Ограничение нагрузки: включение, token bucket на IP и на пользователя (запросов в секунду
+# и запас), лимит одновременных запросов на класс маршрутов (0 - без лимита) и число хранимых ключей
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+ADMISSION_IP_RATE = float(os.getenv("ADMISSION_IP_RATE", 100))
+ADMISSION_IP_BURST = float(os.getenv("ADMISSION_IP_BURST", 200))
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", 20))
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", 40))
+ADMISSION_MAX_IN_FLIGHT_READ = int(os.getenv("ADMISSION_MAX_IN_FLIGHT_READ", 200))
+ADMISSION_MAX_IN_FLIGHT_WRITE = int(os.getenv("ADMISSION_MAX_IN_FLIGHT_WRITE", 50))
+ADMISSION_MAX_IN_FLIGHT_AUTH = int(os.getenv("ADMISSION_MAX_IN_FLIGHT_AUTH", 32))
+ADMISSION_MAX_KEYS = int(os.getenv("ADMISSION_MAX_KEYS", 100000))
+
+# Архивация переводов: возраст в днях, после которого месячные партиции сворачиваются в
+# archived_transfers и отсоединяются, и на сколько месяцев вперед создавать партиции
+ARCHIVE_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", 365))
+TRANSACTION_PARTITIONS_AHEAD = int(os.getenv("TRANSACTION_PARTITIONS_AHEAD", 3))
+
+# Профилирование запросов: включение, секрет заголовка X-Profile, профилировать каждый N-й
+# запрос (0 - только по заголовку), интервал сэмплирования, каталог и формат (speedscope или collapsed)
+PROFILING = os.getenv("PROFILING", "false").lower() in ("1", "true", "yes")
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_SAMPLE_EVERY = int(os.getenv("PROFILING_SAMPLE_EVERY", 0))
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", 5))
+PROFILING_DIR = os.getenv("PROFILING_DIR", "profiles")
+PROFILING_FORMAT = os.getenv("PROFILING_FORMAT", "speedscope")
+
+# Заголовок Idempotency-Key: хранилище (database - таблица idempotency_keys, memory - LRU в
+# памяти процесса, только для одного процесса), время жизни ключа в секундах и размер LRU
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "database")
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 86400))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 100000))
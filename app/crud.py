@@ -1,63 +1,551 @@
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+import random
+from collections import defaultdict
+from typing import List
+from sqlalchemy import case, func, insert, literal, or_, select, true, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
 from . import models, schemas, auth
+from .cache import info_cache
+from .shards import shard_registry
+
+
+def _insert(db: Session, model):
+    # ON CONFLICT support lives in the dialect packages; SQLite backs the test suite
+    if db.get_bind().dialect.name == "sqlite":
+        return sqlite.insert(model)
+    return postgresql.insert(model)
 
 
 def get_user(db: Session, username: str):
     return db.query(models.User).filter(models.User.username == username).first()
 
 
-def create_user(db: Session, user: schemas.UserCreate):
-    # Check if user already exists
-    if get_user(db, user.username):
-        raise HTTPException(status_code=400, detail="Username already registered")
+def get_user_id(db: Session, username: str):
+    return db.query(models.User.id).filter(models.User.username == username).scalar()
+
+
+def get_user_coins(db: Session, user_id: int):
+    shard_total = select(func.coalesce(func.sum(models.BalanceShard.coins), 0))\
+        .where(models.BalanceShard.user_id == user_id)\
+        .scalar_subquery()
+    return db.query(models.User.coins + shard_total).filter(models.User.id == user_id).scalar()
+
 
-    hashed_password = auth.get_password_hash(user.password)
-    db_user = models.User(username=user.username, password_hash=hashed_password)
+def _insert_user(db: Session, username: str, password_hash: str):
+    # The unique index on username is the existence check; None when taken
+    db_user = models.User(username=username, password_hash=password_hash)
     db.add(db_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
     db.refresh(db_user)
     return db_user
 
 
-def send_coins(db: Session, from_user_id: int, to_user_id: int, amount: int):
-    db_transaction = models.Transaction(from_user_id=from_user_id, to_user_id=to_user_id, amount=amount)
-    db.add(db_transaction)
+def create_user(db: Session, user: schemas.UserCreate, password_hash: str = None):
+    if password_hash is None:
+        password_hash = auth.get_password_hash(user.password)
+    db_user = _insert_user(db, user.username, password_hash)
+    if db_user is None:
+        raise HTTPException(status_code=400, detail="Username already registered")
+    return db_user
+
+
+def get_or_create_user(db: Session, user: schemas.UserCreate, password_hash: str):
+    # For first logins: when a concurrent login of the same name inserted the
+    # row first, returns that row so the caller verifies the password against it
+    db_user = _insert_user(db, user.username, password_hash)
+    if db_user is None:
+        return get_user(db, user.username), False
+    return db_user, True
+
+
+def update_password_hash(db: Session, user_id: int, password_hash: str):
+    db.execute(update(models.User).where(models.User.id == user_id).values(password_hash=password_hash))
     db.commit()
-    db.refresh(db_transaction)
+
+
+def lock_users(db: Session, user_ids):
+    # Row locks on every account a multi-party write touches, taken up front
+    # in id order like send_coins does, so it can't deadlock with a transfer
+    # going the other way. SQLite has no FOR UPDATE; it serializes writers.
+    db.execute(
+        select(models.User.id)
+        .where(models.User.id.in_(user_ids))
+        .order_by(models.User.id)
+        .with_for_update()
+    ).all()
+
+
+def _debit(db: Session, user_id: int, amount: int):
+    return db.execute(
+        update(models.User)
+        .where(models.User.id == user_id, models.User.coins >= amount)
+        .values(coins=models.User.coins - amount)
+        .returning(models.User.coins)
+    ).scalar()
+
+
+def debit_coins(db: Session, user_id: int, amount: int):
+    # Returns the new balance, or None when the user can't afford it
+    balance = _debit(db, user_id, amount)
+    if balance is None:
+        shard_registry.ensure(db)
+    if balance is None and shard_registry.counts.get(user_id):
+        # Credits may be parked in shards; fold them in and retry once
+        if consolidate_balance_shards(db, user_id):
+            balance = _debit(db, user_id, amount)
+    return balance
+
+
+def credit_coins(db: Session, user_id: int, amount: int):
+    credit_many(db, {user_id: amount})
+
+
+def credit_many(db: Session, credits: dict):
+    # credits: user id -> amount. Sharded accounts get a random shard row,
+    # everyone else is updated in place by a single statement.
+    shard_registry.ensure(db)
+    plain = {}
+    for user_id, amount in credits.items():
+        shards = shard_registry.counts.get(user_id)
+        if shards:
+            db.execute(
+                update(models.BalanceShard)
+                .where(models.BalanceShard.user_id == user_id,
+                       models.BalanceShard.shard == random.randrange(shards))
+                .values(coins=models.BalanceShard.coins + amount)
+            )
+        else:
+            plain[user_id] = amount
+    if len(plain) == 1:
+        [(user_id, amount)] = plain.items()
+        db.execute(
+            update(models.User)
+            .where(models.User.id == user_id)
+            .values(coins=models.User.coins + amount)
+        )
+    elif plain:
+        db.execute(
+            update(models.User)
+            .where(models.User.id.in_(plain))
+            .values(coins=models.User.coins + case(plain, value=models.User.id))
+        )
+
+
+def consolidate_balance_shards(db: Session, user_id: int):
+    # Moves shard balances into users.coins inside the caller's transaction.
+    # Subtracting what was read (not zeroing) keeps credits that land meanwhile.
+    shards = db.execute(
+        select(models.BalanceShard.shard, models.BalanceShard.coins)
+        .where(models.BalanceShard.user_id == user_id, models.BalanceShard.coins != 0)
+        .with_for_update()
+    ).all()
+    total = 0
+    for shard, coins in shards:
+        db.execute(
+            update(models.BalanceShard)
+            .where(models.BalanceShard.user_id == user_id, models.BalanceShard.shard == shard)
+            .values(coins=models.BalanceShard.coins - coins)
+        )
+        total += coins
+    if total:
+        db.execute(
+            update(models.User)
+            .where(models.User.id == user_id)
+            .values(coins=models.User.coins + total)
+        )
+    return total
+
+
+def enable_balance_shards(db: Session, user_id: int, shards: int):
+    db.execute(update(models.User).where(models.User.id == user_id).values(balance_shards=shards))
+    stmt = _insert(db, models.BalanceShard).values([
+        {"user_id": user_id, "shard": shard, "coins": 0} for shard in range(shards)
+    ])
+    db.execute(stmt.on_conflict_do_nothing())
+    db.commit()
+    shard_registry.bump()
+
+
+def send_coins(db: Session, from_user_id: int, to_user_id: int, amount: int):
+    if amount <= 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+    try:
+        # Touch rows in id order so opposite transfers can't deadlock
+        for user_id in sorted({from_user_id, to_user_id}):
+            if user_id == from_user_id and debit_coins(db, from_user_id, amount) is None:
+                raise HTTPException(status_code=400, detail="Insufficient funds")
+            if user_id == to_user_id:
+                credit_coins(db, to_user_id, amount)
+        db_transaction = models.Transaction(from_user_id=from_user_id, to_user_id=to_user_id, amount=amount)
+        db.add(db_transaction)
+        record_transfer_summary(db, [(from_user_id, to_user_id, amount)])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    info_cache.invalidate(from_user_id, to_user_id)
     return db_transaction
 
 
+# Rows per transfer_summary upsert: 5 parameters each, well under the 32767
+# bind parameters asyncpg (and SQLite) accept in one statement
+SUMMARY_UPSERT_ROWS = 1000
+
+
+def record_transfer_summary(db: Session, transfers: list):
+    # Adds (from_user_id, to_user_id, amount) transfers to transfer_summary,
+    # one upsert per SUMMARY_UPSERT_ROWS keys. Keys are aggregated (an upsert
+    # can't touch a row twice) and sorted so concurrent transfers lock
+    # summary rows in the same order.
+    totals = defaultdict(lambda: [0, 0])
+    for from_user_id, to_user_id, amount in transfers:
+        for key in ((from_user_id, to_user_id, "sent"), (to_user_id, from_user_id, "received")):
+            totals[key][0] += amount
+            totals[key][1] += 1
+    if not totals:
+        return
+    summary = models.TransferSummary
+    rows = [
+        {"user_id": user_id, "counterparty_id": counterparty_id, "direction": direction,
+         "total": total, "count": count}
+        for (user_id, counterparty_id, direction), (total, count) in sorted(totals.items())
+    ]
+    for start in range(0, len(rows), SUMMARY_UPSERT_ROWS):
+        stmt = _insert(db, summary).values(rows[start:start + SUMMARY_UPSERT_ROWS])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=["user_id", "counterparty_id", "direction"],
+            set_={"total": summary.total + stmt.excluded.total, "count": summary.count + stmt.excluded.count},
+        ))
+
+
+def get_transfer_summary(db: Session, user_id: int):
+    # One row per counterparty and direction, however many transfers there were
+    summary = models.TransferSummary
+    rows = db.execute(
+        select(summary.direction, models.User.username, summary.total, summary.count)
+        .join(models.User, models.User.id == summary.counterparty_id)
+        .where(summary.user_id == user_id)
+        .order_by(summary.direction, models.User.username)
+    ).all()
+    return {
+        "received": [
+            {"fromUser": username, "amount": total, "count": count}
+            for direction, username, total, count in rows if direction == "received"
+        ],
+        "sent": [
+            {"toUser": username, "amount": total, "count": count}
+            for direction, username, total, count in rows if direction == "sent"
+        ],
+    }
+
+
+def transfer_coins(db: Session, from_user_id: int, to_username: str, amount: int):
+    to_user_id = get_user_id(db, to_username)
+    if to_user_id is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return send_coins(db, from_user_id, to_user_id, amount)
+
+
+def send_coins_batch(db: Session, from_user_id: int, transfers: List[schemas.SendCoinRequest]):
+    if not transfers:
+        raise HTTPException(status_code=400, detail="No transfers given")
+    if any(transfer.amount <= 0 for transfer in transfers):
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+
+    usernames = {transfer.toUser for transfer in transfers}
+    user_ids = dict(
+        db.query(models.User.username, models.User.id)
+          .filter(models.User.username.in_(usernames))
+          .all()
+    )
+    missing = usernames - user_ids.keys()
+    if missing:
+        raise HTTPException(status_code=404, detail=f"User not found: {', '.join(sorted(missing))}")
+
+    credits = defaultdict(int)
+    for transfer in transfers:
+        credits[user_ids[transfer.toUser]] += transfer.amount
+    total = sum(credits.values())
+
+    try:
+        lock_users(db, {from_user_id, *credits})
+        if debit_coins(db, from_user_id, total) is None:
+            raise HTTPException(status_code=400, detail="Insufficient funds")
+        # One UPDATE for every recipient, one batched INSERT for the ledger
+        credit_many(db, credits)
+        db.execute(insert(models.Transaction), [
+            {"from_user_id": from_user_id, "to_user_id": user_ids[transfer.toUser], "amount": transfer.amount}
+            for transfer in transfers
+        ])
+        record_transfer_summary(db, [
+            (from_user_id, user_ids[transfer.toUser], transfer.amount) for transfer in transfers
+        ])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    info_cache.invalidate(from_user_id, *credits)
+    return total
+
+
+def apply_transfers(db: Session, transfers: list):
+    """Apply (from_user_id, to_username, amount) transfers without committing.
+
+    Returns one entry per transfer: the recorded Transaction, or the
+    HTTPException that rejected it. Rejected transfers leave no changes, so
+    the caller can commit the rest as a single group.
+    """
+    usernames = {to_username for _, to_username, _ in transfers}
+    user_ids = dict(
+        db.query(models.User.username, models.User.id)
+          .filter(models.User.username.in_(usernames))
+          .all()
+    )
+    senders = {from_user_id for from_user_id, _, _ in transfers}
+    lock_users(db, senders | set(user_ids.values()))
+    results = []
+    credits = defaultdict(int)
+    for from_user_id, to_username, amount in transfers:
+        to_user_id = user_ids.get(to_username)
+        if to_user_id is None:
+            results.append(HTTPException(status_code=404, detail="User not found"))
+        elif amount <= 0:
+            results.append(HTTPException(status_code=400, detail="Amount must be positive"))
+        elif debit_coins(db, from_user_id, amount) is None:
+            results.append(HTTPException(status_code=400, detail="Insufficient funds"))
+        else:
+            # Senders are credited immediately so their own debits later in the
+            # group see the money; everyone else is credited in one UPDATE
+            if to_user_id in senders:
+                credit_coins(db, to_user_id, amount)
+            else:
+                credits[to_user_id] += amount
+            results.append(models.Transaction(from_user_id=from_user_id, to_user_id=to_user_id, amount=amount))
+
+    if credits:
+        credit_many(db, credits)
+    recorded = [result for result in results if isinstance(result, models.Transaction)]
+    db.add_all(recorded)
+    record_transfer_summary(db, [(t.from_user_id, t.to_user_id, t.amount) for t in recorded])
+    db.flush()
+    return results
+
+
 def get_merchandise(db: Session, item_name: str):
     return db.query(models.Merchandise).filter(models.Merchandise.name == item_name).first()
 
 
-def add_item_to_inventory(db: Session, user_id: int, merchandise: models.Merchandise):
-    db_inventory = models.Inventory(user_id=user_id, merchandise_id=merchandise.id)
-    db.add(db_inventory)
+def get_all_merchandise(db: Session):
+    return db.query(models.Merchandise).all()
+
+
+def seed_merchandise(db: Session, items: List[dict]) -> bool:
+    # Safe to run from several workers at once: concurrent inserts of the same
+    # name resolve to DO NOTHING and the price update is idempotent. Returns
+    # whether any row was added or repriced.
+    if not items:
+        return False
+    inserted = db.execute(
+        _insert(db, models.Merchandise).values(items).on_conflict_do_nothing(index_elements=["name"])
+    ).rowcount
+    prices = {item["name"]: item["price"] for item in items}
+    new_price = case(prices, value=models.Merchandise.name)
+    updated = db.execute(
+        update(models.Merchandise)
+        .where(models.Merchandise.name.in_(prices), models.Merchandise.price != new_price)
+        .values(price=new_price)
+    ).rowcount
+    db.commit()
+    return bool(inserted or updated)
+
+
+def add_items_to_inventory(db: Session, user_id: int, quantities: dict):
+    # quantities: merchandise id -> number of units; one multi-row upsert
+    stmt = _insert(db, models.Inventory).values([
+        {"user_id": user_id, "merchandise_id": merchandise_id, "quantity": quantity}
+        for merchandise_id, quantity in quantities.items()
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[models.Inventory.user_id, models.Inventory.merchandise_id],
+        set_={"quantity": models.Inventory.quantity + stmt.excluded.quantity},
+    ))
+
+
+def cart_total(cart: list) -> int:
+    return sum(merchandise.price * quantity for merchandise, quantity in cart)
+
+
+def checkout(db: Session, user_id: int, cart: list):
+    # cart: (merchandise, quantity) pairs, priced by the caller's catalog
+    quantities = defaultdict(int)
+    for merchandise, quantity in cart:
+        quantities[merchandise.id] += quantity
+    total = cart_total(cart)
+    try:
+        if debit_coins(db, user_id, total) is None:
+            raise HTTPException(status_code=400, detail="Insufficient funds")
+        add_items_to_inventory(db, user_id, quantities)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    info_cache.invalidate(user_id)
+    return total
+
+
+def get_idempotent_response(db: Session, user_id: int, key: str, now):
+    # Primary key lookup; `live` is false for an expired row not purged yet
+    return db.execute(
+        select(models.IdempotencyKey.fingerprint, models.IdempotencyKey.response,
+               (models.IdempotencyKey.expires_at > now).label("live"))
+        .where(models.IdempotencyKey.user_id == user_id, models.IdempotencyKey.key == key)
+    ).first()
+
+
+def claim_idempotency_key(db: Session, user_id: int, key: str, fingerprint: str, response: str, now, expires_at):
+    # No commit: the row commits together with the request's writes. A
+    # concurrent claim of the same key blocks on the row lock until that
+    # request commits or rolls back. An expired row is taken over.
+    idempotency_key = models.IdempotencyKey
+    stmt = _insert(db, idempotency_key).values(
+        user_id=user_id, key=key, fingerprint=fingerprint, response=response, expires_at=expires_at,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "key"],
+        set_={"fingerprint": stmt.excluded.fingerprint, "response": stmt.excluded.response,
+              "expires_at": stmt.excluded.expires_at},
+        where=idempotency_key.expires_at <= now,
+    ).returning(idempotency_key.key)
+    return db.execute(stmt).first() is not None
+
+
+def purge_idempotency_keys(db: Session, now) -> int:
+    deleted = db.query(models.IdempotencyKey)\
+                .filter(models.IdempotencyKey.expires_at <= now)\
+                .delete(synchronize_session=False)
     db.commit()
+    return deleted
 
 
 def get_user_inventory(db: Session, user_id: int):
-    return db.query(models.Merchandise)\
+    return db.query(models.Merchandise.name, models.Inventory.quantity)\
              .join(models.Inventory)\
              .filter(models.Inventory.user_id == user_id)\
              .all()
 
-def get_user_coin_history(db: Session, user_id: int):
-    received = db.query(models.Transaction).filter(models.Transaction.to_user_id == user_id).all()
-    sent = db.query(models.Transaction).filter(models.Transaction.from_user_id == user_id).all()
+def _coin_history_rows(db: Session, user_id: int, direction: str, limit: int = None):
+    # Column-only join: one statement per direction, no per-row lazy loads
+    if direction == "received":
+        own, counterparty = models.Transaction.to_user_id, models.Transaction.from_user_id
+    else:
+        own, counterparty = models.Transaction.from_user_id, models.Transaction.to_user_id
+    live = select(models.User.username, models.Transaction.amount, models.Transaction.id.label("seq"))\
+        .join(models.User, models.User.id == counterparty)\
+        .where(own == user_id)
 
+    if limit is not None:
+        # Most recent `limit` entries, still returned oldest first
+        return db.execute(live.order_by(models.Transaction.id.desc()).limit(limit)).all()[::-1]
+
+    # Transfers rolled up by app.archive come first, one entry per counterparty
+    archived = select(models.User.username, models.ArchivedTransfer.total.label("amount"), literal(0).label("seq"))\
+        .join(models.User, models.User.id == models.ArchivedTransfer.counterparty_id)\
+        .where(models.ArchivedTransfer.user_id == user_id, models.ArchivedTransfer.direction == direction)
+    rows = union_all(archived, live).subquery()
+    return db.execute(select(rows.c.username, rows.c.amount).order_by(rows.c.seq)).all()
+
+
+def get_user_coin_history(db: Session, user_id: int, limit: int = None):
     received_history = [
-        {"fromUser": trans.from_user.username, "amount": trans.amount}
-        for trans in received
+        {"fromUser": username, "amount": amount}
+        for username, amount, *_ in _coin_history_rows(db, user_id, "received", limit)
     ]
     sent_history = [
-        {"toUser": trans.to_user.username, "amount": trans.amount}
-        for trans in sent
+        {"toUser": username, "amount": amount}
+        for username, amount, *_ in _coin_history_rows(db, user_id, "sent", limit)
     ]
 
     return {
         "received": received_history,
         "sent": sent_history
-    }
\ No newline at end of file
+    }
+
+
+def roll_up_transfers(db: Session, source):
+    # Adds the transfers in `source` (a table or subquery with from_user_id,
+    # to_user_id and amount) to archived_transfers, both directions at once.
+    # No commit: the caller removes the source rows in the same transaction.
+    sent = select(source.c.from_user_id, source.c.to_user_id, literal("sent"),
+                  func.sum(source.c.amount), func.count())\
+        .group_by(source.c.from_user_id, source.c.to_user_id)
+    received = select(source.c.to_user_id, source.c.from_user_id, literal("received"),
+                      func.sum(source.c.amount), func.count())\
+        .group_by(source.c.to_user_id, source.c.from_user_id)
+    rows = union_all(sent, received).subquery()
+    archived = models.ArchivedTransfer
+    # WHERE true: SQLite can't otherwise tell the upsert clause from a join
+    stmt = _insert(db, archived).from_select(
+        ["user_id", "counterparty_id", "direction", "total", "count"],
+        select(rows).where(true()),
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id", "counterparty_id", "direction"],
+        set_={"total": archived.total + stmt.excluded.total, "count": archived.count + stmt.excluded.count},
+    ))
+
+
+def _history_select():
+    sender = aliased(models.User)
+    recipient = aliased(models.User)
+    return select(
+        models.Transaction.id,
+        sender.username.label("fromUser"),
+        recipient.username.label("toUser"),
+        models.Transaction.amount,
+    ).join(sender, sender.id == models.Transaction.from_user_id)\
+     .join(recipient, recipient.id == models.Transaction.to_user_id)
+
+
+def _history_filters(user_id: int, direction: schemas.HistoryDirection):
+    filters = []
+    if direction in (schemas.HistoryDirection.all, schemas.HistoryDirection.received):
+        filters.append(models.Transaction.to_user_id == user_id)
+    if direction in (schemas.HistoryDirection.all, schemas.HistoryDirection.sent):
+        filters.append(models.Transaction.from_user_id == user_id)
+    return filters
+
+
+def get_history_page(db: Session, user_id: int, direction: schemas.HistoryDirection,
+                     limit: int, before_id: int = None):
+    # Keyset pagination, newest first. Each direction walks its own
+    # (user_id, id) index with its own LIMIT before the two are merged; the
+    # extra row tells whether there is a next page.
+    branches = []
+    for condition in _history_filters(user_id, direction):
+        branch = select(models.Transaction.id).where(condition)
+        if before_id is not None:
+            branch = branch.where(models.Transaction.id < before_id)
+        branches.append(select(branch.order_by(models.Transaction.id.desc()).limit(limit + 1).subquery().c.id))
+
+    ids = branches[0] if len(branches) == 1 else union_all(*branches)
+    rows = db.execute(
+        _history_select()
+        .where(models.Transaction.id.in_(ids))
+        .order_by(models.Transaction.id.desc())
+        .limit(limit + 1)
+    ).mappings().all()
+
+    next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+    return {"items": [dict(row) for row in rows[:limit]], "nextCursor": next_cursor}
+
+
+def history_export_query(user_id: int, direction: schemas.HistoryDirection):
+    return _history_select()\
+        .where(or_(*_history_filters(user_id, direction)))\
+        .order_by(models.Transaction.id)
@@ -1,11 +1,111 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from .config import DATABASE_URL
+from sqlalchemy.pool import NullPool
+from starlette.concurrency import run_in_threadpool
+from .metrics import instrument_engine
+from .profiling import trace_calls
+from .config import (
+    DATABASE_URL, READ_DATABASE_URL, ASYNC_DB, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_PGBOUNCER,
+)
 
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+def async_url(url: str) -> str:
+    return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def engine_options(is_async: bool = False) -> dict:
+    if DB_PGBOUNCER:
+        # PgBouncer does the pooling; in transaction mode a server connection
+        # may change between statements, so asyncpg must not prepare them
+        options = {"poolclass": NullPool}
+        if is_async:
+            options["connect_args"] = {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+        return options
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+engine = create_engine(DATABASE_URL, **engine_options())
+read_engine = engine if READ_DATABASE_URL == DATABASE_URL else create_engine(READ_DATABASE_URL, **engine_options())
+read_is_primary = read_engine is engine
+instrument_engine(engine)
+instrument_engine(read_engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+async_engine = None
+async_read_engine = None
+AsyncSessionLocal = None
+AsyncReadSessionLocal = None
+if ASYNC_DB:
+    async_engine = create_async_engine(async_url(DATABASE_URL), **engine_options(is_async=True))
+    async_read_engine = async_engine if read_is_primary else \
+        create_async_engine(async_url(READ_DATABASE_URL), **engine_options(is_async=True))
+    instrument_engine(async_engine.sync_engine)
+    instrument_engine(async_read_engine.sync_engine)
+    # expire_on_commit=False: attributes must stay readable outside the greenlet
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    AsyncReadSessionLocal = async_sessionmaker(async_read_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
+
+
+async def run(db, fn, *args, **kwargs):
+    # crud/auth functions are written against a sync Session. With an AsyncSession
+    # they run inside its greenlet on the event loop, otherwise in the thread pool.
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(trace_calls(fn), db, *args, **kwargs)
+
+
+def stream(db, statement, batch_size: int, render):
+    # Yields render(row) for rows read from a server-side cursor batch_size at
+    # a time. Returns an async iterator for AsyncSession and a plain one (run in
+    # the thread pool by StreamingResponse) for Session.
+    statement = statement.execution_options(yield_per=batch_size)
+    if isinstance(db, AsyncSession):
+        async def rows():
+            result = await db.stream(statement)
+            async for row in result.mappings():
+                yield render(row)
+        return rows()
+
+    def rows():
+        for row in db.execute(statement).mappings():
+            yield render(row)
+    return rows()
+
+
+def warm_pool(engine, connections: int = DB_POOL_SIZE):
+    # Opens the pooled connections up front so the first requests after a
+    # worker starts don't pay for the connects
+    if isinstance(engine.pool, NullPool):
+        return
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(engine.connect())
+    finally:
+        for connection in opened:
+            connection.close()
+
+
+async def warm_async_pool(engine, connections: int = DB_POOL_SIZE):
+    if isinstance(engine.pool, NullPool):
+        return
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(await engine.connect().start())
+    finally:
+        for connection in opened:
+            await connection.close()
@@ -0,0 +1,97 @@
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
+from .metrics import auth_latency
+from .profiling import trace_calls
+from .config import BCRYPT_ROUNDS, HASH_WORKERS, HASH_QUEUE_DEPTH
+
+# min/max pinned to the configured cost so needs_update() flags hashes made with another cost
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+# Jobs running in the pool plus jobs waiting for a worker
+_slots = threading.BoundedSemaphore(max(HASH_WORKERS, 1) + HASH_QUEUE_DEPTH)
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(password, hashed_password)
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    return pwd_context.needs_update(hashed_password)
+
+
+def _get_executor():
+    global _executor
+    if HASH_WORKERS <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            # spawn: forking a process that already runs threads is unsafe
+            _executor = ProcessPoolExecutor(
+                max_workers=HASH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _executor
+
+
+async def _submit(operation, fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=503,
+            detail="Too many pending password checks",
+            headers={"Retry-After": "1"},
+        )
+    try:
+        # Includes the wait for a free worker, which is what the caller sees
+        with auth_latency.time(operation):
+            executor = _get_executor()
+            if executor is None:
+                return await run_in_threadpool(trace_calls(fn), *args)
+            return await asyncio.wrap_future(executor.submit(fn, *args))
+    finally:
+        _slots.release()
+
+
+async def hash_password_async(password: str) -> str:
+    return await _submit("bcrypt_hash", hash_password, password)
+
+
+async def verify_password_async(password: str, hashed_password: str) -> bool:
+    return await _submit("bcrypt_verify", verify_password, password, hashed_password)
+
+
+def _ping() -> bool:
+    return True
+
+
+def warm():
+    # Starts the worker processes now: a spawned worker pays for a fresh
+    # interpreter and the passlib import, which should not land on a login
+    executor = _get_executor()
+    if executor is not None:
+        for future in [executor.submit(_ping) for _ in range(HASH_WORKERS)]:
+            future.result()
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
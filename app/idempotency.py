@@ -0,0 +1,167 @@
+"""Idempotency-Key support for /api/sendCoin, /api/buy and /api/buy/{item}.
+
+The first successful response to a key is kept for IDEMPOTENCY_TTL seconds;
+repeating the request with the same key returns it without touching
+balances. Keys are scoped to the user. Failed requests keep nothing, so a
+retry runs again. Expired rows of the database store are deleted with
+
+    python -m app.idempotency purge
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from . import crud, database, metrics
+from .cache import LRUCache
+from .config import IDEMPOTENCY_BACKEND, IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_SIZE
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(route: str, request: dict) -> str:
+    # Same key with a different request is a client bug, not a retry
+    body = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{route}\n{body}".encode()).hexdigest()
+
+
+def _replay(stored_fingerprint: str, response: dict, request_fingerprint: str):
+    if stored_fingerprint != request_fingerprint:
+        raise HTTPException(status_code=422, detail=f"{HEADER} was already used for a different request")
+    return JSONResponse(response, headers={"Idempotent-Replayed": "true"})
+
+
+class MemoryStore:
+    """Responses in a per-process LRU; for single-process deployments.
+
+    A duplicate of a request still running waits for it, then replays its
+    response, or runs itself if the first one failed.
+    """
+
+    def __init__(self, maxsize: int = IDEMPOTENCY_CACHE_SIZE, ttl: float = IDEMPOTENCY_TTL):
+        self.responses = LRUCache(maxsize, ttl)
+        self.replays = 0
+        self.waits = 0
+        self._in_flight = {}  # (user_id, key) -> (fingerprint, Future)
+        self._lock = threading.Lock()
+
+    @property
+    def evictions(self) -> int:
+        return self.responses.evictions
+
+    def __len__(self):
+        return len(self.responses)
+
+    async def execute(self, db, user_id: int, key: str, request_fingerprint: str, response: dict, perform):
+        cache_key = (user_id, key)
+        while True:
+            with self._lock:
+                stored = self.responses.get(cache_key)
+                pending = None if stored is not None else self._in_flight.get(cache_key)
+                if stored is None and pending is None:
+                    # Threads and event loops may differ between requests
+                    done = concurrent.futures.Future()
+                    self._in_flight[cache_key] = (request_fingerprint, done)
+                    break
+            if stored is not None:
+                replayed = _replay(*stored, request_fingerprint)
+                self.replays += 1
+                return replayed
+            pending_fingerprint, pending_done = pending
+            if pending_fingerprint != request_fingerprint:
+                raise HTTPException(status_code=422, detail=f"{HEADER} was already used for a different request")
+            self.waits += 1
+            await asyncio.wrap_future(pending_done)
+
+        try:
+            await perform()
+            self.responses.set(cache_key, (request_fingerprint, response))
+        finally:
+            with self._lock:
+                del self._in_flight[cache_key]
+            done.set_result(None)
+        return response
+
+
+class DatabaseStore:
+    """Responses in the idempotency_keys table, shared by all workers.
+
+    The key is claimed in the request's own transaction and commits with its
+    writes. A concurrent duplicate blocks on the claimed row until the first
+    request finishes, then replays the committed response.
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL):
+        self.ttl = ttl
+        self.replays = 0
+        self.waits = 0
+        self.evictions = 0
+
+    async def execute(self, db, user_id: int, key: str, request_fingerprint: str, response: dict, perform):
+        now = datetime.now(timezone.utc)
+        stored = await database.run(db, crud.get_idempotent_response, user_id, key, now)
+        if stored is None or not stored.live:
+            claimed = await database.run(
+                db, crud.claim_idempotency_key, user_id, key, request_fingerprint,
+                json.dumps(response), now, now + timedelta(seconds=self.ttl),
+            )
+            if claimed:
+                if stored is not None:
+                    # Took over an expired row that purge hadn't removed yet
+                    self.evictions += 1
+                await perform()
+                return response
+            # Lost to a duplicate that has committed by now
+            self.waits += 1
+            await database.run(db, lambda session: session.rollback())
+            stored = await database.run(db, crud.get_idempotent_response, user_id, key, now)
+            if stored is None or not stored.live:
+                raise HTTPException(status_code=409, detail=f"A request with this {HEADER} is in progress")
+        replayed = _replay(stored.fingerprint, json.loads(stored.response), request_fingerprint)
+        self.replays += 1
+        return replayed
+
+    def purge(self, db, now: datetime = None) -> int:
+        deleted = crud.purge_idempotency_keys(db, now or datetime.now(timezone.utc))
+        self.evictions += deleted
+        return deleted
+
+
+store = MemoryStore() if IDEMPOTENCY_BACKEND == "memory" else DatabaseStore()
+
+
+async def execute(db, user_id: int, key, route: str, request: dict, response: dict, perform):
+    """Runs perform() and returns response, or replays the response stored for key."""
+    if key is None:
+        await perform()
+        return response
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+    return await store.execute(db, user_id, key, fingerprint(route, request), response, perform)
+
+
+@metrics.registry.collector
+def idempotency_metrics():
+    yield "idempotency_replays_total", "counter", "Responses replayed for a repeated Idempotency-Key", store.replays
+    yield "idempotency_waits_total", "counter", "Duplicates that waited for the in-flight request", store.waits
+    yield "idempotency_evictions_total", "counter", "Idempotency keys evicted or expired", store.evictions
+
+
+def main():
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["purge"])
+    parser.parse_args()
+
+    with SessionLocal() as db:
+        print(f"expired idempotency keys deleted: {DatabaseStore().purge(db)}")
+
+
+if __name__ == "__main__":
+    main()
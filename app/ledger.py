@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from fastapi import HTTPException
+from sqlalchemy.exc import DBAPIError
+from . import crud, models
+from .cache import info_cache
+from .config import LEDGER_GROUP_COMMIT, LEDGER_BATCH_SIZE, LEDGER_FLUSH_INTERVAL_MS, LEDGER_MAX_PENDING
+from .database import SessionLocal
+
+_STOP = object()
+# PostgreSQL serialization_failure and deadlock_detected
+RETRYABLE_SQLSTATES = {"40001", "40P01"}
+
+
+def is_retryable(exc: Exception) -> bool:
+    return isinstance(exc, DBAPIError) and getattr(exc.orig, "pgcode", None) in RETRYABLE_SQLSTATES
+
+
+class LedgerWriter:
+    """Group commit for coin transfers.
+
+    Requests enqueue transfers and wait on a Future. A single writer thread
+    applies up to batch_size queued transfers, or whatever arrived within
+    flush_interval, in one database transaction, then resolves each Future
+    with that transfer's own outcome: the transaction id or the
+    HTTPException that rejected it.
+    """
+
+    def __init__(self, session_factory, enabled: bool = False, batch_size: int = 100,
+                 flush_interval: float = 0.005, max_pending: int = 10000):
+        self.session_factory = session_factory
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batches = 0
+        self.transfers = 0
+        self.retries = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="ledger-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def submit(self, from_user_id: int, to_username: str, amount: int) -> Future:
+        self.start()
+        future = Future()
+        try:
+            self._queue.put_nowait((from_user_id, to_username, amount, future))
+        except queue.Full:
+            raise HTTPException(status_code=503, detail="Too many pending transfers",
+                                headers={"Retry-After": "1"})
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _apply(self, transfers):
+        affected = set()
+        with self.session_factory() as db:
+            try:
+                results = crud.apply_transfers(db, transfers)
+                for index, result in enumerate(results):
+                    if isinstance(result, models.Transaction):
+                        affected.update((result.from_user_id, result.to_user_id))
+                        results[index] = result.id
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        return results, affected
+
+    def _flush(self, batch):
+        transfers = [(from_user_id, to_username, amount) for from_user_id, to_username, amount, _ in batch]
+        try:
+            try:
+                results, affected = self._apply(transfers)
+            except DBAPIError as exc:
+                # One conflicting transfer shouldn't fail the whole group; the
+                # rollback left nothing behind, so run it again once
+                if not is_retryable(exc):
+                    raise
+                self.retries += 1
+                results, affected = self._apply(transfers)
+        except Exception as exc:
+            for *_, future in batch:
+                future.set_exception(exc)
+            return
+
+        self.batches += 1
+        self.transfers += len(batch)
+        info_cache.invalidate(*affected)
+        for (*_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+ledger_writer = LedgerWriter(
+    SessionLocal,
+    enabled=LEDGER_GROUP_COMMIT,
+    batch_size=LEDGER_BATCH_SIZE,
+    flush_interval=LEDGER_FLUSH_INTERVAL_MS / 1000,
+    max_pending=LEDGER_MAX_PENDING,
+)
@@ -1,9 +1,21 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from . import crud, models, schemas, database, auth
-from .config import SECRET_KEY
-from typing import List
+from . import crud, schemas, database, auth, hashing, idempotency, metrics, profiling, serialization
+from .admission import AdmissionMiddleware
+from .cache import info_cache
+from .catalog import merchandise_catalog
+from .ledger import ledger_writer
+from .shards import shard_registry
+from .config import (
+    SECRET_KEY, ASYNC_DB, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, HISTORY_STREAM_BATCH,
+    TRANSFER_BATCH_MAX_SIZE, READ_REPLICA_CACHE_TTL, PROFILING,
+)
+from typing import List, Optional
 
 MERCHANDISE_ITEMS = [
     {"name": "t-shirt", "price": 80},
@@ -18,37 +30,103 @@ MERCHANDISE_ITEMS = [
     {"name": "pink-hoody", "price": 500}
 ]
 
-app = FastAPI()
+def prepare_worker():
+    with database.SessionLocal() as db:
+        if crud.seed_merchandise(db, MERCHANDISE_ITEMS):
+            merchandise_catalog.bump()
+        merchandise_catalog.load(db)
+        shard_registry.ensure(db)
+    if ASYNC_DB:
+        # Requests go through the async engines, warmed in the lifespan; don't
+        # hold the seeding connection in the sync pool
+        database.engine.dispose()
+    else:
+        database.warm_pool(database.engine)
+        if not database.read_is_primary:
+            database.warm_pool(database.read_engine)
+    hashing.warm()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Uvicorn starts accepting requests on this worker only after startup finishes
+    await run_in_threadpool(prepare_worker)
+    if ASYNC_DB:
+        await database.warm_async_pool(database.async_engine)
+        if not database.read_is_primary:
+            await database.warm_async_pool(database.async_read_engine)
+    yield
+    ledger_writer.stop()
+    hashing.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+# The last middleware added runs first: shed requests still show up in the
+# metrics, and profiles cover only admitted requests
+if PROFILING:
+    app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth")
 
 
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+if ASYNC_DB:
+    async def get_db():
+        async with database.AsyncSessionLocal() as db:
+            yield db
+
+    async def get_read_db():
+        async with database.AsyncReadSessionLocal() as db:
+            yield db
+else:
+    def get_db():
+        db = database.SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def get_read_db():
+        db = database.ReadSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+async def ensure_catalog(db):
+    if merchandise_catalog.stale:
+        await database.run(db, merchandise_catalog.load)
 
 
 @app.post("/api/auth", response_model=schemas.AuthResponse)
-def authenticate(request: schemas.AuthRequest, db: Session = Depends(get_db)):
-    try:
-        user = auth.authenticate_user(db, request.username, request.password)
-    except HTTPException:
+async def authenticate(request: schemas.AuthRequest, db: Session = Depends(get_db)):
+    user = await database.run(db, crud.get_user, request.username)
+    created = False
+    if user is None:
         # Если пользователь не найден, создаем нового
-        hashed_password = auth.get_password_hash(request.password)
-        user = crud.create_user(db, request)
-
-    access_token = auth.create_access_token(data={"sub": user.username})
+        password_hash = await hashing.hash_password_async(request.password)
+        # A concurrent first login of the same name may win the insert; this
+        # request then checks the password against the row it created
+        user, created = await database.run(db, crud.get_or_create_user, request, password_hash)
+    if not created:
+        if not await hashing.verify_password_async(request.password, user.password_hash):
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        if hashing.needs_rehash(user.password_hash):
+            password_hash = await hashing.hash_password_async(request.password)
+            await database.run(db, crud.update_password_hash, user.id, password_hash)
+
+    access_token = auth.create_access_token(data={"sub": user.username, "uid": user.id})
     return {"token": access_token}
 
 
 @app.post("/api/register", response_model=schemas.AuthResponse)
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     try:
-        new_user = crud.create_user(db, user)
-        access_token = auth.create_access_token(data={"sub": new_user.username})
+        password_hash = await hashing.hash_password_async(user.password)
+        new_user = await database.run(db, crud.create_user, user, password_hash)
+        access_token = auth.create_access_token(data={"sub": new_user.username, "uid": new_user.id})
         return {"token": access_token}
     except HTTPException as e:
         raise e
@@ -56,86 +134,166 @@ def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/api/info", response_model=schemas.InfoResponse)
-def get_info(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    user = auth.get_current_user(db, token)
+@app.get("/api/info", response_model=schemas.InfoResponse, response_model_exclude_none=True)
+async def get_info(historyLimit: Optional[int] = Query(None, ge=1),
+                   historyMode: schemas.HistoryMode = schemas.HistoryMode.full,
+                   token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
+    user = await database.run(db, auth.get_current_user, token)
     if user is None:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    inventory_items = crud.get_user_inventory(db, user.id)
-    inventory_dict = {}
-    for item in inventory_items:
-        if item.name in inventory_dict:
-            inventory_dict[item.name].quantity += 1
-        else:
-            inventory_dict[item.name] = schemas.InventoryItem(
-                type=item.name,
-                quantity=1
-            )
+    summary = historyMode == schemas.HistoryMode.summary
+    variant = "summary" if summary else historyLimit
+    # Version is read before the queries; writes bump it after commit
+    version, cached = info_cache.lookup(user.id, variant)
+    if cached is not None:
+        return serialization.fast_response(cached)
+
+    inventory_items = await database.run(db, crud.get_user_inventory, user.id)
+    inventory = [
+        {"type": name, "quantity": quantity}
+        for name, quantity in inventory_items
+    ]
+
+    if summary:
+        # Totals per counterparty, O(counterparties) instead of O(transfers)
+        history = {"coinSummary": await database.run(db, crud.get_transfer_summary, user.id)}
+    else:
+        history = {"coinHistory": await database.run(db, crud.get_user_coin_history, user.id, historyLimit)}
+    coins = await database.run(db, crud.get_user_coins, user.id)
+
+    info = {
+        "coins": coins,
+        "inventory": inventory,
+        **history
+    }
+    # A lagging replica may have served pre-write data under the new version
+    ttl = None if database.read_is_primary else READ_REPLICA_CACHE_TTL
+    info_cache.store(user.id, version, info, variant, ttl)
+    return serialization.fast_response(info)
 
-    coin_history = crud.get_user_coin_history(db, user.id)
 
-    return {
-        "coins": user.coins,
-        "inventory": list(inventory_dict.values()),
-        "coinHistory": coin_history
-    }
+@app.get("/api/history", response_model=schemas.HistoryPage)
+async def get_history(cursor: Optional[int] = None,
+                      limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+                      direction: schemas.HistoryDirection = schemas.HistoryDirection.all,
+                      token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
+    user = await database.run(db, auth.get_current_user, token)
+    page = await database.run(db, crud.get_history_page, user.id, direction, limit, cursor)
+    return serialization.fast_response(page)
+
+
+@app.get("/api/history/export")
+async def export_history(direction: schemas.HistoryDirection = schemas.HistoryDirection.all,
+                         token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
+    user = await database.run(db, auth.get_current_user, token)
+    lines = database.stream(
+        db, crud.history_export_query(user.id, direction), HISTORY_STREAM_BATCH,
+        lambda row: serialization.dumps(dict(row)) + b"\n",
+    )
+    return StreamingResponse(lines, media_type="application/x-ndjson")
 
 
 @app.post("/api/sendCoin")
-def send_coins(request: schemas.SendCoinRequest, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    from_user = auth.get_current_user(db, token)
-    if from_user is None:
+async def send_coins(request: schemas.SendCoinRequest, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db),
+                     idempotency_key: Optional[str] = Header(None, alias=idempotency.HEADER)):
+    principal = await database.run(db, auth.get_current_user, token)
+    if principal is None:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    to_user = crud.get_user(db, request.toUser)
-    if not to_user:
-        raise HTTPException(status_code=404, detail="User not found")
+    async def transfer():
+        # A stored idempotency key has to commit in the transfer's transaction
+        if ledger_writer.enabled and idempotency_key is None:
+            await asyncio.wrap_future(ledger_writer.submit(principal.id, request.toUser, request.amount))
+        else:
+            await database.run(db, crud.transfer_coins, principal.id, request.toUser, request.amount)
+
+    return await idempotency.execute(
+        db, principal.id, idempotency_key, "sendCoin", request.dict(), {"message": "Coins sent successfully"},
+        transfer,
+    )
 
-    if from_user.coins < request.amount:
-        raise HTTPException(status_code=400, detail="Insufficient funds")
 
-    crud.send_coins(db, from_user.id, to_user.id, request.amount)
+@app.post("/api/sendCoin/batch")
+async def send_coins_batch(request: schemas.SendCoinBatchRequest, token: str = Depends(oauth2_scheme),
+                           db: Session = Depends(get_db)):
+    principal = await database.run(db, auth.get_current_user, token)
+    if principal is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if len(request.transfers) > TRANSFER_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {TRANSFER_BATCH_MAX_SIZE} transfers per batch")
 
-    from_user.coins -= request.amount
-    to_user.coins += request.amount
-    db.commit()
+    total = await database.run(db, crud.send_coins_batch, principal.id, request.transfers)
 
-    return {"message": "Coins sent successfully"}
+    return {"message": "Coins sent successfully", "count": len(request.transfers), "total": total}
 
 
-@app.get("/api/buy/{item}")
-def buy_item(item: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    user = auth.get_current_user(db, token)
-    if user is None:
+async def checkout_cart(items: List[schemas.CartItem], token: str, db, respond, idempotency_key: str,
+                        route: str, request: dict):
+    # respond(total) builds the response body
+    principal = await database.run(db, auth.get_current_user, token)
+    if principal is None:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if not items:
+        raise HTTPException(status_code=400, detail="Cart is empty")
 
-    merchandise = crud.get_merchandise(db, item)
-    if not merchandise:
-        raise HTTPException(status_code=404, detail="Item not found")
+    await ensure_catalog(db)
+    cart = []
+    for cart_item in items:
+        merchandise = merchandise_catalog.get(cart_item.item)
+        if not merchandise:
+            raise HTTPException(status_code=404, detail="Item not found")
+        if cart_item.quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be positive")
+        cart.append((merchandise, cart_item.quantity))
 
-    if user.coins < merchandise.price:
-        raise HTTPException(status_code=400, detail="Insufficient funds")
+    async def checkout():
+        await database.run(db, crud.checkout, principal.id, cart)
 
-    user.coins -= merchandise.price
-    crud.add_item_to_inventory(db, user.id, merchandise)
-    db.commit()
+    # Priced up front so the response can be stored along with the key
+    response = respond(crud.cart_total(cart))
+    return await idempotency.execute(db, principal.id, idempotency_key, route, request, response, checkout)
 
-    return {"message": f"Item {item} bought successfully"}
 
+@app.post("/api/buy")
+async def buy_items(request: schemas.CheckoutRequest, token: str = Depends(oauth2_scheme),
+                    db: Session = Depends(get_db),
+                    idempotency_key: Optional[str] = Header(None, alias=idempotency.HEADER)):
+    return await checkout_cart(request.items, token, db,
+                               lambda total: {"message": "Items bought successfully", "total": total},
+                               idempotency_key, "buy", request.dict())
 
-@app.on_event("startup")
-async def initialize_merchandise():
-    db = next(get_db())
-    for item in MERCHANDISE_ITEMS:
-        existing_item = db.query(models.Merchandise).filter(models.Merchandise.name == item["name"]).first()
-        if not existing_item:
-            db_item = models.Merchandise(name=item["name"], price=item["price"])
-            db.add(db_item)
-    db.commit()
-    db.close()
+
+@app.get("/api/buy/{item}")
+async def buy_item(item: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db),
+                   idempotency_key: Optional[str] = Header(None, alias=idempotency.HEADER)):
+    return await checkout_cart([schemas.CartItem(item=item)], token, db,
+                               lambda total: {"message": f"Item {item} bought successfully"},
+                               idempotency_key, "buy/item", {"item": item})
 
 
 @app.get("/api/merchandise", response_model=List[schemas.MerchandiseResponse])
-def get_merchandise(db: Session = Depends(get_db)):
-    return db.query(models.Merchandise).all()
\ No newline at end of file
+async def get_merchandise(request: Request, db: Session = Depends(get_read_db)):
+    await ensure_catalog(db)
+    headers = {"ETag": merchandise_catalog.etag, "Cache-Control": "no-cache"}
+    if merchandise_catalog.matches(request.headers.get("if-none-match")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # Pre-rendered body, skips response_model validation
+    return Response(merchandise_catalog.body, media_type="application/json", headers=headers)
+
+
+@metrics.registry.collector
+def cache_metrics():
+    yield "token_cache_hits_total", "counter", "Principal cache hits", auth.principal_cache.hits
+    yield "token_cache_misses_total", "counter", "Principal cache misses", auth.principal_cache.misses
+    yield "token_cache_evictions_total", "counter", "Principal cache evictions", auth.principal_cache.evictions
+    yield "info_cache_hits_total", "counter", "/api/info cache hits", info_cache.hits
+    yield "info_cache_misses_total", "counter", "/api/info cache misses", info_cache.misses
+    yield "info_cache_invalidations_total", "counter", "/api/info cache invalidations", info_cache.invalidations
+    yield "ledger_batches_total", "counter", "Group-commit batches written", ledger_writer.batches
+    yield "ledger_transfers_total", "counter", "Transfers written by the group-commit writer", ledger_writer.transfers
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
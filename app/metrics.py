@@ -0,0 +1,286 @@
+import contextvars
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from sqlalchemy import event
+from .config import SLOW_REQUEST_MS
+
+logger = logging.getLogger("app.metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in sorted(self.samples().items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Callback(_Metric):
+    """Reads {label values: value} from read() at scrape time, for state kept elsewhere."""
+
+    def __init__(self, name: str, documentation: str, labelnames, read, kind: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self._read = read
+
+    def samples(self) -> dict:
+        return self._read()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per-bucket (non-cumulative) counts, sum, count
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels):
+        state = self._values.get(labels)
+        return state[2] if state else 0
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self._lock:
+            items = sorted((labels, ([*state[0]], state[1], state[2])) for labels, state in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                label_str = _format_labels(self.labelnames, labels, [("le", _format_value(bound))])
+                yield f"{self.name}_bucket{label_str} {cumulative}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(total)}"
+            yield f"{self.name}_count{label_str} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        # fn() -> iterable of (name, kind, documentation, value) read at scrape time
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, documentation, value in collect():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status")))
+http_latency = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route")))
+http_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests being processed", ("method",)))
+request_statements = registry.register(Histogram(
+    "http_request_db_statements", "SQL statements per HTTP request", ("route",), buckets=COUNT_BUCKETS))
+request_db_time = registry.register(Histogram(
+    "http_request_db_seconds", "Time spent executing SQL per HTTP request", ("route",)))
+db_statements = registry.register(Counter(
+    "db_statements_total", "SQL statements executed"))
+db_pool_wait = registry.register(Histogram(
+    "db_pool_checkout_seconds", "Time spent waiting for a pooled connection",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)))
+auth_latency = registry.register(Histogram(
+    "auth_operation_seconds", "bcrypt and JWT operation latency", ("operation",)))
+
+
+class RequestStats:
+    __slots__ = ("statements", "db_time", "pool_wait", "user")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.user = None  # username, set once the token is checked
+
+
+# Set by the middleware; the same object is visible from the thread pool and the
+# AsyncSession greenlet because both run in a copy of the request's context
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    db_statements.inc()
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+
+
+def instrument_engine(engine):
+    """Count statements, SQL time and pool checkout wait for a sync Engine."""
+    if engine.pool.__dict__.get("_instrumented"):
+        return engine
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    pool = engine.pool
+    connect = pool.connect
+
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            elapsed = time.perf_counter() - started
+            db_pool_wait.observe(elapsed)
+            stats = current_request.get()
+            if stats is not None:
+                stats.pool_wait += elapsed
+
+    pool.connect = timed_connect
+    pool._instrumented = True
+    return engine
+
+
+_route_paths = {}
+
+
+def route_template(scope) -> str:
+    # Label by route template, not the raw path, to keep cardinality bounded
+    endpoint = scope.get("endpoint")
+    path = _route_paths.get(endpoint)
+    if path is None:
+        path = next((route.path for route in scope["app"].routes
+                     if endpoint is not None and getattr(route, "endpoint", None) is endpoint), "unmatched")
+        _route_paths[endpoint] = path
+    return path
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, cheaper than BaseHTTPMiddleware on every request."""
+
+    def __init__(self, app, slow_request_ms: float = None):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+        stats = RequestStats()
+        token = current_request.set(stats)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_in_flight.inc(method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec(method)
+            current_request.reset(token)
+            route = route_template(scope)
+            http_requests.inc(method, route, str(status_code))
+            http_latency.observe(elapsed, method, route)
+            request_statements.observe(stats.statements, route)
+            request_db_time.observe(stats.db_time, route)
+            slow_ms = SLOW_REQUEST_MS if self.slow_request_ms is None else self.slow_request_ms
+            if slow_ms and elapsed * 1000 >= slow_ms:
+                logger.warning(
+                    "slow request %s %s user=%s status=%s %.1fms queries=%d db=%.1fms pool_wait=%.1fms",
+                    method, scope["path"], stats.user, status_code, elapsed * 1000,
+                    stats.statements, stats.db_time * 1000, stats.pool_wait * 1000,
+                )
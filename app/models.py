@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, DateTime, Integer, String, ForeignKey, Index, UniqueConstraint, func
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -6,10 +6,12 @@ from .database import Base
 class User(Base):
     __tablename__ = 'users'
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     username = Column(String, unique=True, index=True)
     password_hash = Column(String)
     coins = Column(Integer, default=1000)
+    # >0 for hot accounts whose credits are spread over balance_shards rows
+    balance_shards = Column(Integer, nullable=False, default=0, server_default='0')
 
     transactions_received = relationship(
         "Transaction",
@@ -26,11 +28,19 @@ class User(Base):
 
 class Transaction(Base):
     __tablename__ = 'transactions'
+    # History reads filter by one side and order by id.
+    # On PostgreSQL the table is range-partitioned by created_at and its
+    # primary key is (id, created_at); see migration e5b7d3a9c2f1.
+    __table_args__ = (
+        Index('ix_transactions_to_user_id_id', 'to_user_id', 'id'),
+        Index('ix_transactions_from_user_id_id', 'from_user_id', 'id'),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     from_user_id = Column(Integer, ForeignKey('users.id'))
     to_user_id = Column(Integer, ForeignKey('users.id'))
     amount = Column(Integer)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
 
     from_user = relationship(
         "User",
@@ -47,7 +57,7 @@ class Transaction(Base):
 class Merchandise(Base):
     __tablename__ = 'merchandise'
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     name = Column(String, unique=True, index=True)
     price = Column(Integer)
 
@@ -56,10 +66,66 @@ class Merchandise(Base):
 
 class Inventory(Base):
     __tablename__ = 'inventory'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'merchandise_id', name='uq_inventory_user_merchandise'),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     merchandise_id = Column(Integer, ForeignKey('merchandise.id'))
+    quantity = Column(Integer, nullable=False, default=1, server_default='1')
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
 
     user = relationship("User", back_populates="inventory")
-    merchandise = relationship("Merchandise", back_populates="inventories")
\ No newline at end of file
+    merchandise = relationship("Merchandise", back_populates="inventories")
+
+
+class BalanceShard(Base):
+    __tablename__ = 'balance_shards'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    coins = Column(Integer, nullable=False, default=0, server_default='0')
+
+
+class ArchivedTransfer(Base):
+    """Transfers rolled up by app.archive once their partition aged out.
+
+    One row per user, counterparty and direction ('sent' or 'received').
+    """
+    __tablename__ = 'archived_transfers'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    counterparty_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    direction = Column(String, primary_key=True)
+    total = Column(Integer, nullable=False, default=0, server_default='0')
+    count = Column(Integer, nullable=False, default=0, server_default='0')
+
+
+class TransferSummary(Base):
+    """Running totals per user, counterparty and direction ('sent' or 'received').
+
+    Updated in the same transaction as every transfer, archived ones included.
+    """
+    __tablename__ = 'transfer_summary'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    counterparty_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    direction = Column(String, primary_key=True)
+    total = Column(Integer, nullable=False, default=0, server_default='0')
+    count = Column(Integer, nullable=False, default=0, server_default='0')
+
+
+class IdempotencyKey(Base):
+    """First response to a request sent with an Idempotency-Key header.
+
+    Inserted in the same transaction as the request's own writes, so a row
+    exists exactly when those writes committed.
+    """
+    __tablename__ = 'idempotency_keys'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    response = Column(String, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
@@ -0,0 +1,213 @@
+import contextvars
+import hmac
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from starlette.concurrency import run_in_threadpool
+from . import metrics
+from .config import (
+    PROFILING, PROFILING_TOKEN, PROFILING_SAMPLE_EVERY, PROFILING_INTERVAL_MS, PROFILING_DIR, PROFILING_FORMAT,
+)
+
+# Profile of the request running in this context, if any
+active = contextvars.ContextVar("active_profile", default=None)
+
+
+def _stack(frame) -> tuple:
+    # Root first, as collapsed stacks and speedscope expect
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+class Sampler:
+    """Samples the stacks of the threads doing one request's work.
+
+    That is the event loop thread plus worker threads registered through
+    traced() while they run the request's calls. Stacks of an idle selector
+    are dropped; with uvloop an idle loop has no Python frames at all.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.thread_ids = {threading.get_ident()}
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in list(self.thread_ids):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = _stack(frame)
+                if stack and not stack[-1][1].endswith("selectors.py"):
+                    self.samples[stack] += 1
+
+
+def traced(fn):
+    """Wraps fn so its worker thread is sampled while it runs for a profiled request."""
+    sampler = active.get()
+    if sampler is None:
+        return fn
+
+    def run(*args, **kwargs):
+        thread_id = threading.get_ident()
+        sampler.thread_ids.add(thread_id)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sampler.thread_ids.discard(thread_id)
+    return run
+
+
+def untraced(fn):
+    return fn
+
+
+# What database.run and hashing wrap their calls with, bound at import: with
+# profiling off they don't even look up the active profile
+trace_calls = traced if PROFILING else untraced
+
+
+def _frame_name(frame) -> str:
+    name, filename, line = frame
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def collapsed(samples: Counter, root: str) -> str:
+    # One "root;frame;frame count" line per stack, for flamegraph.pl or speedscope
+    return "".join(
+        ";".join([root, *(_frame_name(frame) for frame in stack)]) + f" {count}\n"
+        for stack, count in samples.items()
+    )
+
+
+def speedscope(samples: Counter, name: str, interval_ms: float) -> dict:
+    frame_index = {}
+    frames = []
+    profile_samples = []
+    weights = []
+    for stack, count in samples.items():
+        indexes = []
+        for frame in stack:
+            if frame not in frame_index:
+                frame_index[frame] = len(frames)
+                frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+            indexes.append(frame_index[frame])
+        profile_samples.append(indexes)
+        weights.append(count * interval_ms)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "app.profiling",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": profile_samples,
+            "weights": weights,
+        }],
+    }
+
+
+def _slug(value) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", str(value)).strip("_") or "-"
+
+
+class ProfilingMiddleware:
+    """Profiles requests carrying `X-Profile: <PROFILING_TOKEN>`, and every Nth request.
+
+    Only added to the app when PROFILING is on, so it costs nothing otherwise.
+    Each profile is written to PROFILING_DIR with the route, user, status,
+    duration and SQL statement count in its name.
+    """
+
+    def __init__(self, app, token: str = PROFILING_TOKEN, sample_every: int = PROFILING_SAMPLE_EVERY,
+                 interval_ms: float = PROFILING_INTERVAL_MS, directory: str = PROFILING_DIR,
+                 output_format: str = PROFILING_FORMAT):
+        self.app = app
+        self.token = token.encode()
+        self.sample_every = sample_every
+        self.interval_ms = interval_ms
+        self.directory = directory
+        self.output_format = output_format
+        self.written = 0
+        self._counter = itertools.count(1)
+
+    def _wanted(self, scope) -> bool:
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == b"x-profile":
+                    return hmac.compare_digest(value, self.token)
+        return bool(self.sample_every) and next(self._counter) % self.sample_every == 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        sampler = Sampler(self.interval_ms / 1000)
+        token = active.set(sampler)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            active.reset(token)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            stats = metrics.current_request.get()
+            await run_in_threadpool(
+                self._write, sampler.samples, scope["method"], metrics.route_template(scope),
+                stats.user if stats else None, stats.statements if stats else None,
+                status_code, elapsed_ms,
+            )
+
+    def _write(self, samples, method, route, user, statements, status_code, elapsed_ms):
+        name = f"{method} {route} user={user} status={status_code} sql={statements} {elapsed_ms:.1f}ms"
+        basename = "-".join([
+            time.strftime("%Y%m%dT%H%M%S"), method, _slug(route), _slug(user),
+            f"sql{statements}", f"{elapsed_ms:.0f}ms", uuid.uuid4().hex[:8],
+        ])
+        os.makedirs(self.directory, exist_ok=True)
+        if self.output_format == "collapsed":
+            path = os.path.join(self.directory, basename + ".collapsed")
+            content = collapsed(samples, name.replace(" ", "_").replace(";", ","))
+        else:
+            path = os.path.join(self.directory, basename + ".speedscope.json")
+            content = json.dumps(speedscope(samples, name, self.interval_ms))
+        with open(path, "w") as f:
+            f.write(content)
+        self.written += 1
+        return path
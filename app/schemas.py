@@ -1,3 +1,4 @@
+from enum import Enum
 from pydantic import BaseModel
 from typing import List, Optional
 
@@ -26,6 +27,46 @@ class CoinHistory(BaseModel):
     sent: List[TransactionHistorySent]
 
 
+class CounterpartyReceived(BaseModel):
+    fromUser: str
+    amount: int
+    count: int
+
+
+class CounterpartySent(BaseModel):
+    toUser: str
+    amount: int
+    count: int
+
+
+class CoinSummary(BaseModel):
+    received: List[CounterpartyReceived]
+    sent: List[CounterpartySent]
+
+
+class HistoryMode(str, Enum):
+    full = "full"
+    summary = "summary"
+
+
+class HistoryDirection(str, Enum):
+    all = "all"
+    sent = "sent"
+    received = "received"
+
+
+class HistoryEntry(BaseModel):
+    id: int
+    fromUser: str
+    toUser: str
+    amount: int
+
+
+class HistoryPage(BaseModel):
+    items: List[HistoryEntry]
+    nextCursor: Optional[int]
+
+
 class InventoryItem(BaseModel):
     type: str
     quantity: int
@@ -34,7 +75,9 @@ class InventoryItem(BaseModel):
 class InfoResponse(BaseModel):
     coins: int
     inventory: List[InventoryItem]
-    coinHistory: CoinHistory
+    # coinHistory with historyMode=full, coinSummary with historyMode=summary
+    coinHistory: Optional[CoinHistory]
+    coinSummary: Optional[CoinSummary]
 
 
 class SendCoinRequest(BaseModel):
@@ -42,6 +85,19 @@ class SendCoinRequest(BaseModel):
     amount: int
 
 
+class SendCoinBatchRequest(BaseModel):
+    transfers: List[SendCoinRequest]
+
+
+class CartItem(BaseModel):
+    item: str
+    quantity: int = 1
+
+
+class CheckoutRequest(BaseModel):
+    items: List[CartItem]
+
+
 class ErrorResponse(BaseModel):
     errors: str
 
@@ -54,3 +110,6 @@ class UserCreate(BaseModel):
 class MerchandiseResponse(BaseModel):
     name: str
     price: int
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,28 @@
+import json
+from starlette.responses import JSONResponse
+from .config import FAST_JSON
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def fast_response(content):
+    # With FAST_JSON the handler's plain dicts/lists already have the response
+    # model's shape, so returning a Response skips FastAPI's re-validation
+    # and jsonable_encoder pass. Otherwise FastAPI validates as usual.
+    if FAST_JSON:
+        return FastJSONResponse(content)
+    return content
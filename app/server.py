@@ -0,0 +1,44 @@
+"""Production entry point: python -m app.server
+
+One uvicorn worker process per CPU (WEB_WORKERS overrides), uvloop and
+httptools when they are installed. Each worker seeds the catalog and warms
+its caches and connection pool in the lifespan handler before it accepts
+requests.
+"""
+import importlib.util
+import os
+import uvicorn
+from .config import WEB_HOST, WEB_PORT, WEB_WORKERS
+
+
+def _available(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def worker_count() -> int:
+    return WEB_WORKERS if WEB_WORKERS > 0 else (os.cpu_count() or 1)
+
+
+def main():
+    workers = worker_count()
+    if workers > 1:
+        # Web workers already occupy every core; a bcrypt process pool per
+        # worker would only oversubscribe them. Workers are spawned, so they
+        # read this from the environment.
+        os.environ.setdefault("HASH_WORKERS", "0")
+        # Each worker caches /api/info and counts versions on its own, so a
+        # write elsewhere can't invalidate its entries; bound their age instead
+        os.environ.setdefault("INFO_CACHE_TTL", "1")
+    uvicorn.run(
+        "app.main:app",
+        host=WEB_HOST,
+        port=WEB_PORT,
+        workers=workers,
+        loop="uvloop" if _available("uvloop") else "asyncio",
+        http="httptools" if _available("httptools") else "h11",
+        proxy_headers=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import threading
+import time
+from sqlalchemy.orm import Session
+from . import models
+from .config import SHARD_REGISTRY_TTL
+
+
+class ShardRegistry:
+    """Process-wide map of sharded accounts: user id -> number of shards.
+
+    Reloaded after bump() or every `ttl` seconds. A stale map only costs
+    contention: crediting users.coins directly is still correct, because a
+    balance is always users.coins plus its shards.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.counts = {}
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.loaded_at = None
+
+    def ensure(self, db: Session):
+        loaded_at = self.loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < self.ttl:
+            return
+        counts = dict(
+            db.query(models.User.id, models.User.balance_shards)
+              .filter(models.User.balance_shards > 0)
+              .all()
+        )
+        with self._lock:
+            self.counts = counts
+            self.loaded_at = time.monotonic()
+
+
+shard_registry = ShardRegistry(SHARD_REGISTRY_TTL)
+
+
+def main():
+    from . import crud
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Spread credits to a hot account over N balance rows")
+    parser.add_argument("username")
+    parser.add_argument("shards", type=int)
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        user_id = crud.get_user_id(db, args.username)
+        if user_id is None:
+            parser.error(f"unknown user {args.username}")
+        crud.enable_balance_shards(db, user_id, args.shards)
+
+
+if __name__ == "__main__":
+    main()
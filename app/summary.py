@@ -0,0 +1,88 @@
+"""Maintenance for transfer_summary:
+
+    python -m app.summary backfill   # rebuild it from the ledger
+    python -m app.summary check      # compare it with the ledger, exit 1 on mismatch
+
+The ledger is the live transactions plus the totals archived into
+archived_transfers by app.archive.
+"""
+import argparse
+import sys
+from sqlalchemy import func, literal, select, text, union_all
+from sqlalchemy.orm import Session
+from . import models
+
+KEY = ("user_id", "counterparty_id", "direction")
+
+
+def _ledger_rows():
+    # One row per transfer and side, plus the archived totals
+    t = models.Transaction
+    archived = models.ArchivedTransfer
+    return [
+        select(t.from_user_id.label("user_id"), t.to_user_id.label("counterparty_id"),
+               literal("sent").label("direction"), t.amount.label("total"), literal(1).label("count")),
+        select(t.to_user_id, t.from_user_id, literal("received"), t.amount, literal(1)),
+        select(archived.user_id, archived.counterparty_id, archived.direction, archived.total, archived.count),
+    ]
+
+
+def _aggregate(*selects):
+    rows = union_all(*selects).subquery()
+    return select(
+        rows.c.user_id, rows.c.counterparty_id, rows.c.direction,
+        func.sum(rows.c.total).label("total"), func.sum(rows.c.count).label("count"),
+    ).group_by(rows.c.user_id, rows.c.counterparty_id, rows.c.direction)
+
+
+def backfill(db: Session) -> int:
+    """Rebuilds transfer_summary in one transaction; returns the number of rows."""
+    if db.get_bind().dialect.name == "postgresql":
+        # Blocks transfers' summary upserts (not reads) until commit. A transfer
+        # that got its upsert in first has committed and is in the ledger read
+        # below; one that waits adds itself on top of the rebuilt rows.
+        db.execute(text("LOCK TABLE transfer_summary IN EXCLUSIVE MODE"))
+    db.query(models.TransferSummary).delete(synchronize_session=False)
+    db.execute(models.TransferSummary.__table__.insert().from_select(
+        [*KEY, "total", "count"], _aggregate(*_ledger_rows()),
+    ))
+    count = db.query(models.TransferSummary).count()
+    db.commit()
+    return count
+
+
+def check(db: Session) -> list:
+    """Keys where transfer_summary differs from the ledger, with (total, count) differences.
+
+    Ledger minus summary in a single statement, so it reads one snapshot.
+    """
+    summary = models.TransferSummary
+    negated = select(summary.user_id, summary.counterparty_id, summary.direction,
+                     -summary.total, -summary.count)
+    diff = _aggregate(*_ledger_rows(), negated).subquery()
+    rows = db.execute(
+        select(diff).where((diff.c.total != 0) | (diff.c.count != 0))
+    ).all()
+    return [((row.user_id, row.counterparty_id, row.direction), (row.total, row.count)) for row in rows]
+
+
+def main():
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["backfill", "check"])
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.command == "backfill":
+            print(f"transfer_summary rebuilt: {backfill(db)} rows")
+            return
+        mismatches = check(db)
+        for key, (total, count) in mismatches:
+            print(f"{key}: ledger - summary = total {total}, count {count}")
+        print(f"{len(mismatches)} mismatched rows")
+        sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Seed the configured database (DATABASE_URL) with a realistic dataset.
+
+    python -m benchmarks.seed --users 1000 --history 200 --items 20
+
+Every user gets the password "password", `history` outgoing transfers to
+random users and `items` distinct merchandise types in the inventory.
+"""
+import argparse
+import random
+from sqlalchemy import delete, insert
+from app import hashing, models, summary
+from app.database import Base, SessionLocal, engine
+from app.main import MERCHANDISE_ITEMS
+
+PASSWORD = "password"
+CHUNK = 5000
+
+
+def seed(users: int, history: int, items: int, reset: bool = True):
+    Base.metadata.create_all(engine)
+    password_hash = hashing.hash_password(PASSWORD)
+    with SessionLocal() as db:
+        if reset:
+            for model in (models.Transaction, models.ArchivedTransfer, models.TransferSummary, models.Inventory,
+                          models.BalanceShard, models.IdempotencyKey, models.User, models.Merchandise):
+                db.execute(delete(model))
+        db.execute(insert(models.Merchandise), MERCHANDISE_ITEMS)
+        db.execute(insert(models.User), [
+            {"username": f"user{i}", "password_hash": password_hash, "coins": 1_000_000}
+            for i in range(users)
+        ])
+        user_ids = [user_id for (user_id,) in db.query(models.User.id)]
+        merchandise_ids = [merchandise_id for (merchandise_id,) in db.query(models.Merchandise.id)]
+
+        rows = []
+        for from_user_id in user_ids:
+            for _ in range(history):
+                rows.append({"from_user_id": from_user_id, "to_user_id": random.choice(user_ids),
+                             "amount": random.randint(1, 100)})
+                if len(rows) >= CHUNK:
+                    db.execute(insert(models.Transaction), rows)
+                    rows = []
+        if rows:
+            db.execute(insert(models.Transaction), rows)
+
+        inventory = [
+            {"user_id": user_id, "merchandise_id": merchandise_id, "quantity": random.randint(1, 50)}
+            for user_id in user_ids
+            for merchandise_id in random.sample(merchandise_ids, min(items, len(merchandise_ids)))
+        ]
+        if inventory:
+            db.execute(insert(models.Inventory), inventory)
+        db.commit()
+        summary.backfill(db)
+    return [f"user{i}" for i in range(users)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=200)
+    parser.add_argument("--items", type=int, default=5)
+    args = parser.parse_args()
+    seed(args.users, args.history, args.items)
+
+
+if __name__ == "__main__":
+    main()
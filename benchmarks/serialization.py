@@ -0,0 +1,85 @@
+"""CPU cost of rendering /api/info and /api/history bodies, default path vs FAST_JSON.
+
+    python -m benchmarks.serialization --sizes 10 100 1000 10000
+
+The default path is what FastAPI does for a handler returning a dict: validate
+against the route's response_model, run jsonable_encoder and render with the
+stdlib json module. The fast path renders the same dict with
+serialization.FastJSONResponse. No database is involved; the numbers are per
+request and per process.
+"""
+import argparse
+import asyncio
+import time
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from app import serialization
+from app.main import app
+
+
+def info_body(size: int) -> dict:
+    return {
+        "coins": 1000,
+        "inventory": [{"type": name, "quantity": 2} for name in ("cup", "pen", "book", "socks")],
+        "coinHistory": {
+            "received": [{"fromUser": f"user{i % 500}", "amount": i % 97 + 1} for i in range(size)],
+            "sent": [{"toUser": f"user{i % 500}", "amount": i % 89 + 1} for i in range(size)],
+        },
+    }
+
+
+def history_body(size: int) -> dict:
+    return {
+        "items": [
+            {"id": size - i, "fromUser": "alice", "toUser": f"user{i % 500}", "amount": i % 97 + 1}
+            for i in range(size)
+        ],
+        "nextCursor": None,
+    }
+
+
+def response_field(path: str):
+    return next(route.secure_cloned_response_field for route in app.routes if getattr(route, "path", None) == path)
+
+
+async def per_request(render, content, min_time: float) -> float:
+    # Repeat until min_time has passed; returns seconds per call
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        await render(content)
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+async def measure(sizes, min_time: float):
+    for path, build in (("/api/info", info_body), ("/api/history", history_body)):
+        field = response_field(path)
+
+        async def default(content):
+            return JSONResponse(await serialize_response(field=field, response_content=content)).body
+
+        async def fast(content):
+            return serialization.FastJSONResponse(content).body
+
+        print(path)
+        for size in sizes:
+            content = build(size)
+            slow = await per_request(default, content, min_time)
+            quick = await per_request(fast, content, min_time)
+            print(f"  {size:>7} rows: default {slow * 1e6:10.1f} us   fast {quick * 1e6:10.1f} us"
+                  f"   saved {(slow - quick) * 1e6:10.1f} us ({slow / quick:5.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds spent per measurement")
+    args = parser.parse_args()
+    asyncio.run(measure(args.sizes, args.min_time))
+
+
+if __name__ == "__main__":
+    main()
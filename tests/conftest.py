@@ -0,0 +1,150 @@
+import os
+import re
+from collections import Counter
+from contextlib import contextmanager
+
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("HASH_WORKERS", "0")
+# Every TestClient request comes from the same address
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from app import models
+from app.metrics import instrument_engine
+from app.cache import info_cache
+from app.catalog import merchandise_catalog
+from app.shards import shard_registry
+from app.database import Base
+from app.main import app, get_db, get_read_db, MERCHANDISE_ITEMS
+
+
+# Default for query_budget: the same statement shape more than this many times
+# in one block is reported as a likely N+1 (a debit and a credit legitimately
+# run the same UPDATE twice)
+MAX_REPEATS = 2
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_PARAM_LISTS = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|\$\d+|:\w+)\s*,?)+\)")
+_ROW_LISTS = re.compile(r"(\(\.\.\.\)\s*,\s*)+\(\.\.\.\)")
+
+
+def statement_shape(statement: str) -> str:
+    """Normalizes a statement so queries differing only in parameters compare equal."""
+    shape = " ".join(statement.split())
+    shape = _PARAM_LISTS.sub("(...)", shape)
+    shape = _ROW_LISTS.sub("(...)", shape)
+    return _LITERALS.sub("?", shape)
+
+
+class QueryLog(list):
+    def shapes(self) -> Counter:
+        return Counter(statement_shape(statement) for statement in self)
+
+    def repeated(self, max_repeats: int = MAX_REPEATS) -> dict:
+        return {shape: n for shape, n in self.shapes().items() if n > max_repeats}
+
+
+@contextmanager
+def count_queries(engine, budget: int = None, max_repeats: int = None):
+    """Collects statements sent through engine inside the block.
+
+    budget fails the block when more statements were issued, max_repeats when
+    one statement shape repeats more often (a likely N+1).
+    """
+    log = QueryLog()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        log.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield log
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    if budget is not None:
+        assert len(log) <= budget, \
+            f"{len(log)} statements, budget is {budget}:\n" + "\n".join(log)
+    if max_repeats is not None:
+        repeated = log.repeated(max_repeats)
+        assert not repeated, "likely N+1, repeated statements:\n" + "\n".join(
+            f"{n}x {shape}" for shape, n in repeated.items())
+
+
+@pytest.fixture
+def query_budget():
+    """count_queries with N+1 detection on by default; pass max_repeats=None to turn it off."""
+    def budget(engine, budget=None, max_repeats=MAX_REPEATS):
+        return count_queries(engine, budget=budget, max_repeats=max_repeats)
+    return budget
+
+
+@pytest.fixture(autouse=True)
+def reset_caches():
+    # Every test starts from its own database, so drop what earlier tests cached
+    merchandise_catalog.bump()
+    shard_registry.bump()
+    info_cache.clear()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "test.db"
+
+
+@pytest.fixture
+def engine(db_path):
+    engine = create_engine(
+        f"sqlite:///{db_path}",
+        connect_args={"check_same_thread": False, "timeout": 30},
+    )
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add_all(models.Merchandise(**item) for item in MERCHANDISE_ITEMS)
+        db.commit()
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session_factory(engine):
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture(params=["sync", "async"])
+def db_client(request, engine, session_factory, db_path):
+    """TestClient backed by a real SQLite database, run once per DB mode."""
+    if request.param == "async":
+        # NullPool: TestClient may drive each request on a fresh event loop
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}", poolclass=NullPool)
+        async_factory = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+        async def override_get_db():
+            async with async_factory() as db:
+                yield db
+        db_engine = async_engine.sync_engine
+    else:
+        def override_get_db():
+            db = session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+        db_engine = engine
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    instrument_engine(db_engine)
+    client = TestClient(app)
+    # Engine the requests actually go through, for statement counting
+    client.db_engine = db_engine
+    yield client
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
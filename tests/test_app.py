@@ -1,15 +1,40 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import pytest
 from unittest.mock import Mock, patch
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
-from app.main import app
-from app import crud, models, schemas
+from starlette.middleware import Middleware
+from passlib.context import CryptContext
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from app.main import app, get_db, get_read_db
+from app import (
+    admission, archive, auth, crud, database, idempotency, main, models, schemas, hashing, metrics, profiling,
+    serialization, server, summary,
+)
+from app.cache import LocalBackend, LRUCache, VersionedCache, info_cache
+from app.catalog import merchandise_catalog
+from app.ledger import LedgerWriter, ledger_writer
 
 client = TestClient(app)
 
 
 @pytest.fixture
 def mock_db():
-    return Mock()
+    db = Mock()
+    # No sharded accounts
+    db.query.return_value.filter.return_value.all.return_value = []
+    app.dependency_overrides[get_db] = lambda: db
+    yield db
+    app.dependency_overrides.pop(get_db, None)
 
 
 @pytest.fixture
@@ -45,43 +70,45 @@ def test_get_user(mock_db, mock_user):
 
 
 def test_send_coins(mock_db):
-    transaction = models.Transaction(
-        id=1,
-        from_user_id=1,
-        to_user_id=2,
-        amount=100
-    )
-
-    mock_db.add = Mock()
-    mock_db.commit = Mock()
-    mock_db.refresh = Mock()
+    mock_db.execute.return_value.scalar.return_value = 900
 
     result = crud.send_coins(mock_db, 1, 2, 100)
 
+    # debit, credit, transfer_summary upsert
+    assert mock_db.execute.call_count == 3
     mock_db.add.assert_called_once()
     mock_db.commit.assert_called_once()
-    mock_db.refresh.assert_called_once()
+    mock_db.rollback.assert_not_called()
+    assert result.amount == 100
+
 
+def test_send_coins_insufficient_funds_rolls_back(mock_db):
+    mock_db.execute.return_value.scalar.return_value = None
 
-@patch('app.main.get_db')
-def test_merchandise_purchase_flow(mock_get_db, mock_db, mock_user):
-    mock_get_db.return_value = mock_db
+    with pytest.raises(HTTPException) as exc_info:
+        crud.send_coins(mock_db, 1, 2, 100)
 
+    assert exc_info.value.status_code == 400
+    mock_db.add.assert_not_called()
+    mock_db.commit.assert_not_called()
+    mock_db.rollback.assert_called_once()
+
+
+def test_merchandise_purchase_flow(mock_db, mock_user):
+    merchandise_catalog.set_items([models.Merchandise(id=1, name="t-shirt", price=80)])
     with patch('app.auth.get_current_user', return_value=mock_user):
-        with patch('app.crud.get_merchandise', return_value=models.Merchandise(id=1, name="t-shirt", price=80)):
+        with patch('app.crud.get_merchandise') as get_merchandise:
             response = client.get(
                 "/api/buy/t-shirt",
                 headers={"Authorization": "Bearer test_token"}
             )
             assert response.status_code == 200
+            get_merchandise.assert_not_called()
 
 
-@patch('app.main.get_db')
-def test_coin_transfer_flow(mock_get_db, mock_db, mock_user):
-    mock_get_db.return_value = mock_db
-
+def test_coin_transfer_flow(mock_db, mock_user):
     with patch('app.auth.get_current_user', return_value=mock_user):
-        with patch('app.crud.get_user', return_value=models.User(id=2, username="receiver", coins=1000)):
+        with patch('app.crud.get_user_id', return_value=2):
             response = client.post(
                 "/api/sendCoin",
                 headers={"Authorization": "Bearer test_token"},
@@ -90,16 +117,1038 @@ def test_coin_transfer_flow(mock_get_db, mock_db, mock_user):
             assert response.status_code == 200
 
 
-@patch('app.main.get_db')
-def test_insufficient_funds(mock_get_db, mock_db, mock_user):
-    mock_get_db.return_value = mock_db
-
+def test_insufficient_funds(mock_db, mock_user):
+    mock_db.execute.return_value.scalar.return_value = None
     with patch('app.auth.get_current_user', return_value=mock_user):
-        with patch('app.crud.get_user', return_value=models.User(id=2, username="receiver", coins=1000)):
+        with patch('app.crud.get_user_id', return_value=2):
             response = client.post(
                 "/api/sendCoin",
                 headers={"Authorization": "Bearer test_token"},
                 json={"toUser": "receiver", "amount": 2000}
             )
             assert response.status_code == 400
-            assert "Insufficient funds" in response.json()["detail"]
\ No newline at end of file
+            assert "Insufficient funds" in response.json()["detail"]
+
+
+# Интеграционные тесты (SQLite, sync и async режимы)
+def auth_headers(client, username, password="secret"):
+    response = client.post("/api/auth", json={"username": username, "password": password})
+    assert response.status_code == 200
+    return {"Authorization": f"Bearer {response.json()['token']}"}
+
+
+def test_concurrent_first_login(db_client, monkeypatch):
+    auth_headers(db_client, "alice")
+    # This login's lookup ran before the other one's insert committed
+    get_user = crud.get_user
+    lookups = []
+
+    def get_user_late(db, username):
+        lookups.append(username)
+        return None if len(lookups) == 1 else get_user(db, username)
+
+    monkeypatch.setattr(crud, "get_user", get_user_late)
+    assert db_client.post("/api/auth", json={"username": "alice", "password": "secret"}).status_code == 200
+    lookups.clear()
+    assert db_client.post("/api/auth", json={"username": "alice", "password": "wrong"}).status_code == 401
+    assert db_client.post("/api/register", json={"username": "alice", "password": "secret"}).status_code == 400
+
+
+def test_buy_and_transfer_roundtrip(db_client):
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+
+    assert db_client.get("/api/buy/cup", headers=alice).status_code == 200
+    response = db_client.post("/api/sendCoin", headers=alice, json={"toUser": "bob", "amount": 100})
+    assert response.status_code == 200
+
+    info = db_client.get("/api/info", headers=alice).json()
+    assert info == {
+        "coins": 880,
+        "inventory": [{"type": "cup", "quantity": 1}],
+        "coinHistory": {"received": [], "sent": [{"toUser": "bob", "amount": 100}]},
+    }
+
+
+def test_auth_rejects_wrong_password(db_client):
+    auth_headers(db_client, "alice")
+    response = db_client.post("/api/auth", json={"username": "alice", "password": "wrong"})
+    assert response.status_code == 401
+
+
+def test_merchandise_list(db_client):
+    response = db_client.get("/api/merchandise")
+    assert response.status_code == 200
+    assert {"name": "cup", "price": 20} in response.json()
+
+
+def test_first_login_hashes_once(db_client):
+    with patch('app.hashing.hash_password', wraps=hashing.hash_password) as hash_password:
+        auth_headers(db_client, "alice")
+        auth_headers(db_client, "alice")
+    assert hash_password.call_count == 1
+
+
+def test_login_rehashes_on_cost_change(db_client, session_factory):
+    old_context = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=5)
+    with session_factory() as db:
+        db.add(models.User(username="alice", password_hash=old_context.hash("secret"), coins=1000))
+        db.commit()
+
+    auth_headers(db_client, "alice")
+
+    with session_factory() as db:
+        password_hash = crud.get_user(db, "alice").password_hash
+    assert password_hash.startswith("$2b$04$")
+    assert hashing.verify_password("secret", password_hash)
+
+
+def test_hashing_process_pool(monkeypatch):
+    monkeypatch.setattr(hashing, "HASH_WORKERS", 1)
+
+    async def roundtrip():
+        password_hash = await hashing.hash_password_async("secret")
+        return await hashing.verify_password_async("secret", password_hash)
+
+    try:
+        assert asyncio.run(roundtrip())
+    finally:
+        hashing.shutdown()
+
+
+def test_hashing_queue_full(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(hashing, "_slots", slots)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(hashing.hash_password_async("secret"))
+    assert exc_info.value.status_code == 503
+
+
+def test_principal_cache_skips_user_lookup(db_client):
+    alice = auth_headers(db_client, "alice")
+    auth.principal_cache.clear()
+    hits, misses = auth.principal_cache.hits, auth.principal_cache.misses
+
+    with patch('app.crud.get_user', wraps=crud.get_user) as get_user:
+        assert db_client.get("/api/info", headers=alice).status_code == 200
+        assert db_client.get("/api/info", headers=alice).status_code == 200
+    get_user.assert_not_called()
+    assert auth.principal_cache.misses == misses + 1
+    assert auth.principal_cache.hits == hits + 1
+
+
+def test_principal_cache_bounded_by_token_exp():
+    token = auth.create_access_token({"sub": "alice", "uid": 1}, expires_delta=timedelta(seconds=-1))
+    with pytest.raises(HTTPException):
+        auth.get_current_user(Mock(), token)
+    assert auth.principal_cache.get(token) is None
+
+
+def test_overdraft_leaves_balances_untouched(db_client):
+    alice = auth_headers(db_client, "alice")
+    bob = auth_headers(db_client, "bob")
+
+    response = db_client.post("/api/sendCoin", headers=alice, json={"toUser": "bob", "amount": 1001})
+    assert response.status_code == 400
+    response = db_client.post("/api/sendCoin", headers=alice, json={"toUser": "nobody", "amount": 1})
+    assert response.status_code == 404
+
+    assert db_client.get("/api/info", headers=alice).json()["coins"] == 1000
+    assert db_client.get("/api/info", headers=bob).json()["coinHistory"]["received"] == []
+
+
+def test_concurrent_transfers_from_one_account(engine, session_factory):
+    with session_factory() as db:
+        db.add_all([
+            models.User(username="alice", password_hash="x", coins=1000),
+            models.User(username="bob", password_hash="x", coins=1000),
+        ])
+        db.commit()
+        alice_id, bob_id = crud.get_user_id(db, "alice"), crud.get_user_id(db, "bob")
+
+    def transfer(i):
+        # Half of the transfers go back the other way
+        from_id, to_name = (alice_id, "bob") if i % 4 else (bob_id, "alice")
+        with session_factory() as db:
+            try:
+                crud.transfer_coins(db, from_id, to_name, 30)
+                return True
+            except HTTPException:
+                return False
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(transfer, range(200)))
+
+    with session_factory() as db:
+        alice = crud.get_user(db, "alice")
+        bob = crud.get_user(db, "bob")
+        transfers = db.query(models.Transaction).all()
+    assert alice.coins >= 0 and bob.coins >= 0
+    assert alice.coins + bob.coins == 2000
+    assert len(transfers) == sum(results)
+    sent_by_alice = sum(t.amount for t in transfers if t.from_user_id == alice_id)
+    sent_by_bob = sum(t.amount for t in transfers if t.from_user_id == bob_id)
+    assert alice.coins == 1000 - sent_by_alice + sent_by_bob
+
+
+def test_repeat_purchases_share_one_inventory_row(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    for item in ("cup", "cup", "pen", "cup"):
+        assert db_client.get(f"/api/buy/{item}", headers=alice).status_code == 200
+
+    info = db_client.get("/api/info", headers=alice).json()
+    assert info["coins"] == 1000 - 3 * 20 - 10
+    assert sorted(info["inventory"], key=lambda i: i["type"]) == [
+        {"type": "cup", "quantity": 3},
+        {"type": "pen", "quantity": 1},
+    ]
+    with session_factory() as db:
+        assert db.query(models.Inventory).count() == 2
+
+
+def test_info_query_count_independent_of_history(db_client, session_factory, query_budget):
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+    db_client.get("/api/info", headers=alice)  # warm the principal cache
+
+    def info_statements():
+        with query_budget(db_client.db_engine) as statements:
+            assert db_client.get("/api/info", headers=alice).status_code == 200
+        return len(statements)
+
+    with session_factory() as db:
+        alice_id, bob_id = crud.get_user_id(db, "alice"), crud.get_user_id(db, "bob")
+        crud.send_coins(db, alice_id, bob_id, 1)
+    small = info_statements()
+
+    with session_factory() as db:
+        for _ in range(50):
+            crud.send_coins(db, alice_id, bob_id, 1)
+            crud.send_coins(db, bob_id, alice_id, 1)
+    large = info_statements()
+
+    assert small == large <= 4
+    info = db_client.get("/api/info", headers=alice).json()
+    assert len(info["coinHistory"]["sent"]) == 51
+    assert info["coinHistory"]["received"][0] == {"fromUser": "bob", "amount": 1}
+
+
+def make_history(session_factory, transfers):
+    with session_factory() as db:
+        for from_name, to_name, amount in transfers:
+            from_id = crud.get_user_id(db, from_name)
+            crud.transfer_coins(db, from_id, to_name, amount)
+
+
+def history_amounts(client, headers, **params):
+    # Walks every page of /api/history
+    amounts, cursor = [], None
+    while True:
+        if cursor is not None:
+            params["cursor"] = cursor
+        page = client.get("/api/history", headers=headers, params=params).json()
+        amounts += [entry["amount"] for entry in page["items"]]
+        cursor = page["nextCursor"]
+        if cursor is None:
+            return amounts
+
+
+def test_history_keyset_pagination(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+    make_history(session_factory, [("alice", "bob", i) if i % 3 else ("bob", "alice", i) for i in range(1, 13)])
+
+    assert history_amounts(db_client, alice, limit=5) == list(range(12, 0, -1))
+
+    sent = db_client.get("/api/history", headers=alice, params={"direction": "sent"}).json()
+    assert all(entry["fromUser"] == "alice" for entry in sent["items"])
+    assert len(sent["items"]) == 8
+    assert sent["nextCursor"] is None
+
+
+def test_history_pagination_single_direction(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    bob = auth_headers(db_client, "bob")
+    make_history(session_factory, [("alice", "bob", i) for i in range(1, 9)])
+
+    expected = list(range(8, 0, -1))
+    assert history_amounts(db_client, alice, limit=3, direction="sent") == expected
+    assert history_amounts(db_client, alice, limit=3) == expected
+    assert history_amounts(db_client, bob, limit=3, direction="received") == expected
+    assert history_amounts(db_client, alice, limit=3, direction="received") == []
+
+
+def test_history_export_streams_ndjson(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+    make_history(session_factory, [("alice", "bob", 1), ("bob", "alice", 2), ("alice", "bob", 3)])
+
+    response = db_client.get("/api/history/export", headers=alice)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["amount"] for row in rows] == [1, 2, 3]
+    assert rows[1] == {"id": rows[1]["id"], "fromUser": "bob", "toUser": "alice", "amount": 2}
+
+
+def test_info_history_limit(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+    make_history(session_factory, [("alice", "bob", i) for i in range(1, 6)])
+
+    info = db_client.get("/api/info", headers=alice, params={"historyLimit": 2}).json()
+    assert info["coinHistory"]["sent"] == [{"toUser": "bob", "amount": 4}, {"toUser": "bob", "amount": 5}]
+
+
+def test_merchandise_etag_and_refresh(db_client, session_factory):
+    response = db_client.get("/api/merchandise")
+    etag = response.headers["etag"]
+
+    response = db_client.get("/api/merchandise", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    with session_factory() as db:
+        db.query(models.Merchandise).filter(models.Merchandise.name == "cup").update({"price": 25})
+        db.commit()
+    # Stays cached until the catalog version is bumped
+    assert db_client.get("/api/merchandise", headers={"If-None-Match": etag}).status_code == 304
+    merchandise_catalog.bump()
+    response = db_client.get("/api/merchandise", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert {"name": "cup", "price": 25} in response.json()
+
+
+def test_buy_unknown_item(db_client):
+    alice = auth_headers(db_client, "alice")
+    assert db_client.get("/api/buy/yacht", headers=alice).status_code == 404
+
+
+def test_info_cache_invalidated_by_writes(db_client, query_budget):
+    alice = auth_headers(db_client, "alice")
+    bob = auth_headers(db_client, "bob")
+    assert db_client.get("/api/info", headers=bob).json()["coins"] == 1000
+    db_client.get("/api/info", headers=alice)
+
+    hits = info_cache.hits
+    with query_budget(db_client.db_engine) as statements:
+        assert db_client.get("/api/info", headers=alice).json()["coins"] == 1000
+    assert statements == []
+    assert info_cache.hits == hits + 1
+
+    invalidations = info_cache.invalidations
+    db_client.get("/api/buy/cup", headers=alice)
+    db_client.post("/api/sendCoin", headers=alice, json={"toUser": "bob", "amount": 30})
+    assert info_cache.invalidations == invalidations + 3
+    assert db_client.get("/api/info", headers=alice).json()["coins"] == 950
+    assert db_client.get("/api/info", headers=bob).json()["coinHistory"]["received"] == [
+        {"fromUser": "alice", "amount": 30},
+    ]
+
+
+def test_lru_cache_eviction_and_ttl():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    cache.set("d", 4, ttl=0)
+    assert cache.get("d") is None
+    assert cache.evictions == 1
+
+
+def test_send_coins_batch(db_client, session_factory, query_budget):
+    alice = auth_headers(db_client, "alice")
+    with session_factory() as db:
+        db.add_all(models.User(username=f"user{i}", password_hash="x", coins=0) for i in range(200))
+        db.commit()
+    transfers = [{"toUser": f"user{i}", "amount": 2} for i in range(200)] + [{"toUser": "user0", "amount": 5}]
+
+    with query_budget(db_client.db_engine) as statements:
+        response = db_client.post("/api/sendCoin/batch", headers=alice, json={"transfers": transfers})
+    assert response.status_code == 200
+    assert response.json()["total"] == 405
+    assert len(statements) <= 7
+
+    assert db_client.get("/api/info", headers=alice).json()["coins"] == 595
+    with session_factory() as db:
+        assert crud.get_user(db, "user0").coins == 7
+        assert crud.get_user(db, "user199").coins == 2
+        assert db.query(models.Transaction).count() == 201
+
+
+def test_send_coins_batch_many_recipients(db_client, session_factory):
+    # 2 summary rows per recipient: one upsert would need 40k bind parameters
+    alice = auth_headers(db_client, "alice")
+    with session_factory() as db:
+        db.execute(insert(models.User), [
+            {"username": f"user{i}", "password_hash": "x", "coins": 0} for i in range(4000)
+        ])
+        db.query(models.User).filter_by(username="alice").update({"coins": 10000})
+        db.commit()
+    transfers = [{"toUser": f"user{i}", "amount": 1} for i in range(4000)]
+    parameters = []
+
+    def count_parameters(conn, cursor, statement, params, context, executemany):
+        if not executemany:
+            parameters.append(len(params))
+
+    event.listen(db_client.db_engine, "before_cursor_execute", count_parameters)
+    try:
+        response = db_client.post("/api/sendCoin/batch", headers=alice, json={"transfers": transfers})
+    finally:
+        event.remove(db_client.db_engine, "before_cursor_execute", count_parameters)
+    assert response.status_code == 200
+    # asyncpg's limit; SQLite builds often allow more
+    assert max(parameters) <= 32767
+    with session_factory() as db:
+        assert db.query(models.TransferSummary).count() == 8000
+        assert summary.check(db) == []
+
+
+def test_send_coins_batch_is_all_or_nothing(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+
+    response = db_client.post("/api/sendCoin/batch", headers=alice, json={"transfers": [
+        {"toUser": "bob", "amount": 10}, {"toUser": "ghost", "amount": 10},
+    ]})
+    assert response.status_code == 404
+    response = db_client.post("/api/sendCoin/batch", headers=alice, json={"transfers": [
+        {"toUser": "bob", "amount": 600}, {"toUser": "bob", "amount": 600},
+    ]})
+    assert response.status_code == 400
+
+    with session_factory() as db:
+        assert crud.get_user(db, "bob").coins == 1000
+        assert db.query(models.Transaction).count() == 0
+
+
+def test_checkout_cart(db_client, query_budget):
+    alice = auth_headers(db_client, "alice")
+    db_client.get("/api/buy/cup", headers=alice)
+
+    with query_budget(db_client.db_engine) as statements:
+        response = db_client.post("/api/buy", headers=alice, json={"items": [
+            {"item": "cup", "quantity": 2}, {"item": "pen", "quantity": 3}, {"item": "cup"},
+        ]})
+    assert response.status_code == 200
+    assert response.json()["total"] == 3 * 20 + 3 * 10
+    assert len(statements) <= 3
+
+    info = db_client.get("/api/info", headers=alice).json()
+    assert info["coins"] == 1000 - 20 - 90
+    assert sorted(info["inventory"], key=lambda i: i["type"]) == [
+        {"type": "cup", "quantity": 4},
+        {"type": "pen", "quantity": 3},
+    ]
+
+
+def test_checkout_rejects_whole_cart(db_client):
+    alice = auth_headers(db_client, "alice")
+    for items, status_code in (
+        ([{"item": "cup"}, {"item": "yacht"}], 404),
+        ([{"item": "cup"}, {"item": "pink-hoody", "quantity": 2}], 400),
+        ([{"item": "cup", "quantity": 0}], 400),
+        ([], 400),
+    ):
+        response = db_client.post("/api/buy", headers=alice, json={"items": items})
+        assert response.status_code == status_code
+
+    info = db_client.get("/api/info", headers=alice).json()
+    assert info["coins"] == 1000
+    assert info["inventory"] == []
+
+
+def test_ledger_writer_groups_commits(session_factory):
+    with session_factory() as db:
+        db.add_all(models.User(username=name, password_hash="x", coins=100) for name in ("alice", "bob", "carol"))
+        db.commit()
+        ids = {name: crud.get_user_id(db, name) for name in ("alice", "bob", "carol")}
+
+    writer = LedgerWriter(session_factory, enabled=True, batch_size=50, flush_interval=0.05)
+    transfers = [("alice", "bob", 30)] * 5 + [("bob", "carol", 10)] * 5 + [("carol", "ghost", 1)]
+    try:
+        futures = [writer.submit(ids[sender], recipient, amount) for sender, recipient, amount in transfers]
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append(future.result(timeout=10))
+            except HTTPException as exc:
+                outcomes.append(exc.status_code)
+    finally:
+        writer.stop()
+
+    assert outcomes[3:5] == [400, 400]
+    assert outcomes[-1] == 404
+    assert writer.batches < writer.transfers == len(transfers)
+    with session_factory() as db:
+        coins = {name: crud.get_user(db, name).coins for name in ids}
+        assert db.query(models.Transaction).count() == 8
+    assert coins == {"alice": 10, "bob": 140, "carol": 150}
+
+
+def test_ledger_writer_retries_deadlocked_group(session_factory, monkeypatch):
+    with session_factory() as db:
+        db.add_all(models.User(username=name, password_hash="x", coins=100) for name in ("alice", "bob"))
+        db.commit()
+        alice_id = crud.get_user_id(db, "alice")
+
+    class Deadlock(Exception):
+        pgcode = "40P01"
+
+    apply_transfers = crud.apply_transfers
+    attempts = []
+
+    def deadlock_once(db, transfers):
+        attempts.append(len(transfers))
+        if len(attempts) == 1:
+            apply_transfers(db, transfers)
+            raise OperationalError("UPDATE users ...", {}, Deadlock())
+        return apply_transfers(db, transfers)
+
+    monkeypatch.setattr(crud, "apply_transfers", deadlock_once)
+    writer = LedgerWriter(session_factory, enabled=True)
+    try:
+        assert writer.submit(alice_id, "bob", 30).result(timeout=10)
+    finally:
+        writer.stop()
+    assert writer.retries == 1 and len(attempts) == 2
+    with session_factory() as db:
+        assert crud.get_user(db, "bob").coins == 130
+        assert db.query(models.Transaction).count() == 1
+
+
+def test_send_coins_through_ledger_writer(db_client, session_factory, monkeypatch):
+    monkeypatch.setattr(ledger_writer, "enabled", True)
+    monkeypatch.setattr(ledger_writer, "session_factory", session_factory)
+    alice = auth_headers(db_client, "alice")
+    bob = auth_headers(db_client, "bob")
+    try:
+        response = db_client.post("/api/sendCoin", headers=alice, json={"toUser": "bob", "amount": 100})
+        assert response.status_code == 200
+        response = db_client.post("/api/sendCoin", headers=alice, json={"toUser": "bob", "amount": 1000})
+        assert response.status_code == 400
+    finally:
+        ledger_writer.stop()
+    assert db_client.get("/api/info", headers=bob).json()["coins"] == 1100
+
+
+def test_sharded_account_balance(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    prize = auth_headers(db_client, "prize")
+    with session_factory() as db:
+        prize_id = crud.get_user_id(db, "prize")
+        crud.enable_balance_shards(db, prize_id, 4)
+
+    for _ in range(8):
+        assert db_client.post("/api/sendCoin", headers=alice, json={"toUser": "prize", "amount": 50}).status_code == 200
+    assert db_client.post("/api/sendCoin/batch", headers=alice,
+                          json={"transfers": [{"toUser": "prize", "amount": 100}]}).status_code == 200
+
+    with session_factory() as db:
+        assert crud.get_user(db, "prize").coins == 1000
+        assert sum(shard.coins for shard in db.query(models.BalanceShard)) == 500
+    assert db_client.get("/api/info", headers=prize).json()["coins"] == 1500
+
+    # Spending past users.coins folds the shards back in
+    response = db_client.post("/api/sendCoin", headers=prize, json={"toUser": "alice", "amount": 1200})
+    assert response.status_code == 200
+    assert db_client.get("/api/info", headers=prize).json()["coins"] == 300
+    response = db_client.post("/api/sendCoin", headers=prize, json={"toUser": "alice", "amount": 301})
+    assert response.status_code == 400
+    with session_factory() as db:
+        assert crud.get_user(db, "prize").coins == 300
+        assert sum(shard.coins for shard in db.query(models.BalanceShard)) == 0
+
+
+def test_reads_routed_to_replica(engine, session_factory, tmp_path, monkeypatch):
+    replica = create_engine(f"sqlite:///{tmp_path / 'replica.db'}", connect_args={"check_same_thread": False})
+    database.Base.metadata.create_all(replica)
+    replica_factory = sessionmaker(bind=replica)
+    with replica_factory() as db:
+        db.add(models.Merchandise(name="replica-only", price=1))
+        db.commit()
+
+    def session_dependency(factory):
+        def dependency():
+            with factory() as db:
+                yield db
+        return dependency
+
+    monkeypatch.setitem(app.dependency_overrides, get_db, session_dependency(session_factory))
+    monkeypatch.setitem(app.dependency_overrides, get_read_db, session_dependency(replica_factory))
+    monkeypatch.setattr(database, "read_is_primary", False)
+
+    assert client.get("/api/merchandise").json() == [{"name": "replica-only", "price": 1}]
+    assert client.post("/api/auth", json={"username": "alice", "password": "secret"}).status_code == 200
+    with session_factory() as db:
+        assert crud.get_user(db, "alice") is not None
+    with replica_factory() as db:
+        assert crud.get_user(db, "alice") is None
+
+
+def test_engine_options(monkeypatch):
+    monkeypatch.setattr(database, "DB_POOL_SIZE", 20)
+    monkeypatch.setattr(database, "DB_POOL_PRE_PING", False)
+    options = database.engine_options()
+    assert options["pool_size"] == 20
+    assert options["pool_pre_ping"] is False
+
+    monkeypatch.setattr(database, "DB_PGBOUNCER", True)
+    assert database.engine_options() == {"poolclass": NullPool}
+    assert database.engine_options(is_async=True)["connect_args"]["statement_cache_size"] == 0
+
+
+def test_metrics_endpoint(db_client):
+    headers = auth_headers(db_client, "metered")
+    before = metrics.request_statements.count("/api/info")
+    assert db_client.get("/api/info", headers=headers).status_code == 200
+    assert db_client.get("/api/buy/no-such-item", headers=headers).status_code == 404
+
+    assert metrics.request_statements.count("/api/info") == before + 1
+    assert metrics.auth_latency.count("bcrypt_hash") >= 1
+    assert metrics.auth_latency.count("jwt_encode") >= 1
+    assert metrics.db_pool_wait.count() >= 1
+
+    body = db_client.get("/metrics").text
+    assert 'http_requests_total{method="GET",route="/api/buy/{item}",status="404"}' in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/info",le="+Inf"}' in body
+    assert 'auth_operation_seconds_count{operation="jwt_decode"}' in body
+    assert "token_cache_hits_total" in body
+    assert 'http_requests_in_flight{method="GET"} 1' in body
+
+
+def test_slow_request_log(db_client, monkeypatch, caplog):
+    headers = auth_headers(db_client, "slowpoke")
+    monkeypatch.setattr(metrics, "SLOW_REQUEST_MS", 0.001)
+    # What a non-zero SLOW_REQUEST_MS binds at import
+    monkeypatch.setattr(auth, "_record_user", True)
+    with caplog.at_level("WARNING", logger="app.metrics"):
+        db_client.get("/api/info", headers=headers)
+    record = next(r for r in caplog.records if "/api/info" in r.getMessage())
+    assert "queries=" in record.getMessage()
+    assert "queries=0" not in record.getMessage()
+    assert "user=slowpoke" in record.getMessage()
+
+
+# Statement budgets per endpoint, checked with enough rows behind every
+# relation that a per-row lazy load would blow the budget or repeat a shape
+ENDPOINT_BUDGETS = [
+    ("POST", "/api/auth", {"json": {"username": "alice", "password": "secret"}}, 1),
+    ("GET", "/api/info", {}, 4),
+    ("GET", "/api/history", {}, 1),
+    ("GET", "/api/history/export", {}, 1),
+    ("GET", "/api/merchandise", {}, 0),
+    ("POST", "/api/sendCoin", {"json": {"toUser": "user1", "amount": 5}}, 5),
+    ("POST", "/api/sendCoin/batch", {"json": {"transfers": [
+        {"toUser": f"user{i}", "amount": 1} for i in range(5)]}}, 6),
+    ("GET", "/api/buy/cup", {}, 2),
+    ("POST", "/api/buy", {"json": {"items": [{"item": "cup"}, {"item": "pen", "quantity": 2}]}}, 2),
+]
+
+
+@pytest.mark.parametrize("method,path,kwargs,budget", ENDPOINT_BUDGETS,
+                         ids=[f"{method} {path}" for method, path, _, _ in ENDPOINT_BUDGETS])
+def test_endpoint_statement_budget(db_client, session_factory, query_budget, method, path, kwargs, budget):
+    alice = auth_headers(db_client, "alice")
+    for i in range(5):
+        auth_headers(db_client, f"user{i}")
+    make_history(session_factory, [("alice", f"user{i}", 1) for i in range(5)]
+                 + [(f"user{i}", "alice", 2) for i in range(5)])
+    for item in ("cup", "pen", "book", "socks"):
+        db_client.get(f"/api/buy/{item}", headers=alice)
+    db_client.get("/api/merchandise")
+    info_cache.clear()
+
+    with query_budget(db_client.db_engine, budget=budget) as statements:
+        response = db_client.request(method, path, headers=alice, **kwargs)
+    assert response.status_code == 200, response.text
+
+
+def test_query_budget_flags_n_plus_one(engine, session_factory, query_budget):
+    with session_factory() as db:
+        db.add_all(models.User(username=name, password_hash="-") for name in ("a", "b0", "b1", "b2", "b3"))
+        db.commit()
+    make_history(session_factory, [("a", f"b{i}", 1) for i in range(4)])
+    with pytest.raises(AssertionError, match="likely N\\+1"):
+        with query_budget(engine), session_factory() as db:
+            # one lazy SELECT per transaction
+            [t.to_user.username for t in db.query(models.Transaction)]
+    with pytest.raises(AssertionError, match="budget is 1"):
+        with query_budget(engine, budget=1, max_repeats=None), session_factory() as db:
+            [t.to_user.username for t in db.query(models.Transaction)]
+
+
+def test_fast_json_matches_validated_responses(db_client, session_factory, monkeypatch):
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+    make_history(session_factory, [("alice", "bob", 3), ("bob", "alice", 1)])
+    db_client.get("/api/buy/cup", headers=alice)
+    paths = ["/api/info", "/api/info?historyLimit=1", "/api/history", "/api/history?direction=sent&limit=1"]
+
+    def responses():
+        info_cache.clear()
+        return [db_client.get(path, headers=alice).json() for path in paths]
+
+    validated = responses()
+    monkeypatch.setattr(serialization, "FAST_JSON", True)
+    assert responses() == validated
+    # cached /api/info goes through the fast path too
+    assert db_client.get("/api/info", headers=alice).json() == validated[0]
+
+
+def test_seed_merchandise_is_idempotent(session_factory):
+    items = [{"name": "cup", "price": 25}, {"name": "mug", "price": 40}]
+    with session_factory() as db:
+        assert crud.seed_merchandise(db, items)
+        assert not crud.seed_merchandise(db, items)
+        prices = dict(db.query(models.Merchandise.name, models.Merchandise.price))
+    assert prices["cup"] == 25
+    assert prices["mug"] == 40
+    assert len(prices) == 11
+
+
+def test_catalog_reloads_after_ttl(db_client, session_factory, monkeypatch):
+    etag = db_client.get("/api/merchandise").headers["etag"]
+    with session_factory() as db:
+        # Another worker or a migration reprices an item
+        db.query(models.Merchandise).filter_by(name="cup").update({"price": 25})
+        db.commit()
+    assert db_client.get("/api/merchandise").headers["etag"] == etag
+
+    monkeypatch.setattr(merchandise_catalog, "loaded_at", merchandise_catalog.loaded_at - merchandise_catalog.ttl)
+    response = db_client.get("/api/merchandise")
+    assert response.headers["etag"] != etag
+    assert {"name": "cup", "price": 25} in response.json()
+
+
+def test_lifespan_prepares_worker(engine, session_factory, monkeypatch):
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "SessionLocal", session_factory)
+    with session_factory() as db:
+        db.query(models.Merchandise).filter_by(name="cup").update({"price": 1})
+        db.commit()
+
+    with TestClient(app):
+        assert not merchandise_catalog.stale
+        assert merchandise_catalog.get("cup").price == 20
+        assert engine.pool.checkedin() > 1
+
+
+def test_prepare_worker_leaves_sync_pool_idle_in_async_mode(engine, session_factory, monkeypatch):
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "SessionLocal", session_factory)
+    monkeypatch.setattr(main, "ASYNC_DB", True)
+    main.prepare_worker()
+    assert not merchandise_catalog.stale
+    assert engine.pool.checkedin() == 0
+
+
+def test_local_backend_bounds_versions():
+    cache = VersionedCache(LocalBackend(2), "info")
+    version, _ = cache.lookup(1)
+    cache.store(1, version, {"coins": 1000})
+    cache.invalidate(1)
+    version, _ = cache.lookup(1)
+    cache.store(1, version, {"coins": 900})
+    # Users 2 and 3 push user 1's version out of the bounded LRU
+    for user_id in (2, 3):
+        cache.invalidate(user_id)
+    assert len(cache.backend.versions) == 2
+
+    # A fresh version, so neither the old nor the current entry is served
+    version, cached = cache.lookup(1)
+    assert cached is None
+    cache.store(1, version, {"coins": 800})
+    assert cache.lookup(1)[1] == {"coins": 800}
+
+
+def test_server_bounds_local_cache_with_several_workers(monkeypatch):
+    monkeypatch.delenv("INFO_CACHE_TTL", raising=False)
+    monkeypatch.setattr(server, "WEB_WORKERS", 4)
+    monkeypatch.setattr(server.uvicorn, "run", lambda *args, **kwargs: None)
+    server.main()
+    assert os.environ["INFO_CACHE_TTL"] == "1"
+
+    cache = VersionedCache(LocalBackend(10, ttl=0.05), "info")
+    version, _ = cache.lookup(1)
+    cache.store(1, version, {"coins": 1000})
+    assert cache.lookup(1)[1] == {"coins": 1000}
+    time.sleep(0.06)
+    assert cache.lookup(1)[1] is None
+
+
+def test_rate_limiter_buckets():
+    limiter = admission.RateLimiter(rate=1, burst=2, maxsize=2)
+    assert limiter.acquire("a", 0.0) == 0
+    assert limiter.acquire("a", 0.0) == 0
+    assert limiter.acquire("a", 0.5) == pytest.approx(0.5)
+    assert limiter.acquire("a", 1.0) == 0
+    assert limiter.rejected == 1
+
+    limiter.acquire("b", 1.0)
+    limiter.acquire("c", 1.0)
+    assert len(limiter) == 2  # "a" was least recently seen
+
+
+def test_admission_control_sheds_load(db_client, monkeypatch):
+    alice = auth_headers(db_client, "alice")
+    relogin = auth_headers(db_client, "alice")
+    # Verified once, so both tokens map to alice's bucket
+    for headers in (alice, relogin):
+        assert db_client.get("/api/info", headers=headers).status_code == 200
+    controller = admission.AdmissionController(
+        enabled=True,
+        ip=admission.RateLimiter(rate=0, burst=0),
+        user=admission.RateLimiter(rate=0.01, burst=2),
+        limits={name: admission.ConcurrencyLimit(1) for name in ("read", "write", "auth")},
+    )
+    monkeypatch.setattr(admission, "controller", controller)
+
+    assert db_client.get("/api/info", headers=alice).status_code == 200
+    assert db_client.get("/api/info", headers=relogin).status_code == 200
+    response = db_client.get("/api/info", headers=alice)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 1
+    # anonymous reads use only the (unlimited) IP bucket
+    assert db_client.get("/api/merchandise").status_code == 200
+
+    controller.limits["read"].in_flight = 1
+    response = db_client.get("/api/merchandise")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert db_client.post("/api/auth", json={"username": "bob", "password": "secret"}).status_code == 200
+
+    body = db_client.get("/metrics").text
+    assert 'admission_rejected_total{reason="user_rate",route_class=""} 1' in body
+    assert set(controller.user._buckets) == {("user", auth.principal_cache.peek(alice["Authorization"][7:]).id)}
+    assert 'admission_rejected_total{reason="in_flight",route_class="read"} 1' in body
+    assert 'admission_in_flight{route_class="read"} 1' in body
+
+
+def test_archive_rolls_up_old_transfers(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    for name in ("bob", "carol"):
+        auth_headers(db_client, name)
+    make_history(session_factory, [("alice", "bob", 5), ("alice", "bob", 7), ("carol", "alice", 3),
+                                   ("alice", "carol", 1)])
+    with session_factory() as db:
+        old_ids = [t.id for t in db.query(models.Transaction).order_by(models.Transaction.id)][:3]
+        db.query(models.Transaction).filter(models.Transaction.id.in_(old_ids))\
+          .update({"created_at": datetime(2020, 1, 1, tzinfo=timezone.utc)}, synchronize_session=False)
+        db.commit()
+        assert archive.archive(db, horizon_days=30) == 3
+        assert db.query(models.Transaction).count() == 1
+        assert db.query(models.ArchivedTransfer).count() == 4
+        assert archive.archive(db, horizon_days=30) == 0
+
+    info_cache.clear()
+    history = db_client.get("/api/info", headers=alice).json()["coinHistory"]
+    assert history["sent"] == [{"toUser": "bob", "amount": 12}, {"toUser": "carol", "amount": 1}]
+    assert history["received"] == [{"fromUser": "carol", "amount": 3}]
+    assert db_client.get("/api/info?historyLimit=5", headers=alice).json()["coinHistory"]["sent"] == [
+        {"toUser": "carol", "amount": 1},
+    ]
+
+
+def test_partition_bounds():
+    moment = datetime(2026, 12, 31, 23, 59, tzinfo=timezone.utc)
+    assert archive.next_month(moment) == datetime(2027, 1, 1, tzinfo=timezone.utc)
+    assert archive.partition_name(archive.month_start(moment)) == "transactions_p202612"
+    assert archive._parse_bound("2026-11-01 00:00:00+00") == datetime(2026, 11, 1, tzinfo=timezone.utc)
+    # a server in another TimeZone renders the same bound with its offset
+    bound = archive._parse_bound("2026-11-01 03:00:00+03")
+    assert bound == datetime(2026, 11, 1, tzinfo=timezone.utc) and bound.utcoffset() == timedelta(0)
+    assert archive.partition_name(bound) == "transactions_p202611"
+
+
+def test_transfer_summary(db_client, session_factory):
+    alice = auth_headers(db_client, "alice")
+    for name in ("bob", "carol"):
+        auth_headers(db_client, name)
+    db_client.post("/api/sendCoin", headers=alice, json={"toUser": "bob", "amount": 10})
+    db_client.post("/api/sendCoin", headers=alice, json={"toUser": "bob", "amount": 5})
+    db_client.post("/api/sendCoin/batch", headers=alice, json={"transfers": [
+        {"toUser": "bob", "amount": 1}, {"toUser": "carol", "amount": 2}]})
+    with session_factory() as db:
+        bob_id, alice_id = crud.get_user_id(db, "bob"), crud.get_user_id(db, "alice")
+        crud.apply_transfers(db, [(bob_id, "alice", 4)])
+        db.commit()
+    info_cache.clear()
+
+    info = db_client.get("/api/info?historyMode=summary", headers=alice).json()
+    assert "coinHistory" not in info
+    assert info["coinSummary"] == {
+        "received": [{"fromUser": "bob", "amount": 4, "count": 1}],
+        "sent": [{"toUser": "bob", "amount": 16, "count": 3}, {"toUser": "carol", "amount": 2, "count": 1}],
+    }
+    assert "coinSummary" not in db_client.get("/api/info", headers=alice).json()
+
+    with session_factory() as db:
+        assert summary.check(db) == []
+        db.query(models.TransferSummary).filter_by(user_id=alice_id, counterparty_id=bob_id, direction="sent")\
+          .update({"total": 1})
+        db.query(models.TransferSummary).filter_by(user_id=bob_id, direction="received").delete()
+        db.commit()
+        assert sorted(summary.check(db)) == [
+            ((alice_id, bob_id, "sent"), (15, 0)),
+            ((bob_id, alice_id, "received"), (16, 3)),
+        ]
+        # the ledger includes archived totals
+        db.query(models.Transaction).update({"created_at": datetime(2020, 1, 1, tzinfo=timezone.utc)})
+        db.commit()
+        archive.archive(db, horizon_days=30)
+        assert summary.backfill(db) == 6
+        assert summary.check(db) == []
+
+
+def test_profiling_middleware(db_client, tmp_path, monkeypatch):
+    alice = auth_headers(db_client, "alice")
+    # What PROFILING=true binds at import
+    monkeypatch.setattr(auth, "_record_user", True)
+    monkeypatch.setattr(database, "trace_calls", profiling.traced)
+    monkeypatch.setattr(hashing, "trace_calls", profiling.traced)
+    # Innermost, as app.main adds it with PROFILING=true
+    monkeypatch.setattr(app, "user_middleware", app.user_middleware + [Middleware(
+        profiling.ProfilingMiddleware, token="let-me-in", sample_every=2, interval_ms=0.5,
+        directory=str(tmp_path / "profiles"), output_format="speedscope",
+    )])
+    monkeypatch.setattr(app, "middleware_stack", None)
+
+    db_client.get("/api/info", headers={**alice, "X-Profile": "let-me-in"})
+    db_client.get("/api/info", headers={**alice, "X-Profile": "wrong"})
+    db_client.get("/api/merchandise")
+    db_client.get("/api/merchandise")  # sampled: 2nd request without the header
+
+    files = sorted(path.name for path in (tmp_path / "profiles").iterdir())
+    assert len(files) == 2
+    assert any("api_merchandise" in name for name in files)
+    info_profile = next(name for name in files if "api_info" in name)
+    assert "-alice-sql" in info_profile and "sql0" not in info_profile
+    profile = json.loads((tmp_path / "profiles" / info_profile).read_text())
+    assert profile["profiles"][0]["type"] == "sampled"
+    assert profile["name"].startswith("GET /api/info user=alice status=200")
+
+
+def test_profiling_off_adds_no_wrappers():
+    assert database.trace_calls is profiling.untraced
+    assert not auth._record_user
+
+
+def test_collapsed_stacks():
+    frames = (("handler", "/app/main.py", 10), ("query", "/app/crud.py", 20))
+    samples = {frames: 3, frames[:1]: 1}
+    assert profiling.collapsed(samples, "GET_/api/info") == (
+        "GET_/api/info;handler (main.py:10);query (crud.py:20) 3\n"
+        "GET_/api/info;handler (main.py:10) 1\n"
+    )
+
+
+def test_idempotency_key_replays_response(db_client, query_budget):
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+    send = {**alice, "Idempotency-Key": "send-1"}
+
+    first = db_client.post("/api/sendCoin", headers=send, json={"toUser": "bob", "amount": 10})
+    with query_budget(db_client.db_engine, budget=1):
+        replay = db_client.post("/api/sendCoin", headers=send, json={"toUser": "bob", "amount": 10})
+    assert replay.status_code == 200 and replay.json() == first.json()
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert db_client.post("/api/sendCoin", headers=send, json={"toUser": "bob", "amount": 11}).status_code == 422
+
+    single = {**alice, "Idempotency-Key": "buy-cup"}
+    assert db_client.get("/api/buy/cup", headers=single).json() == {"message": "Item cup bought successfully"}
+    assert db_client.get("/api/buy/cup", headers=single).headers["Idempotent-Replayed"] == "true"
+    assert db_client.get("/api/buy/pen", headers=single).status_code == 422
+
+    buy = {**alice, "Idempotency-Key": "buy-1"}
+    cart = {"items": [{"item": "cup", "quantity": 2}]}
+    assert db_client.post("/api/buy", headers=buy, json=cart).json()["total"] == 40
+    assert db_client.post("/api/buy", headers=buy, json=cart).json() == \
+        {"message": "Items bought successfully", "total": 40}
+
+    # Failures keep no response, so the key can be retried
+    broke = {**alice, "Idempotency-Key": "buy-2"}
+    assert db_client.post("/api/buy", headers=broke, json={"items": [{"item": "pink-hoody", "quantity": 2}]})\
+        .status_code == 400
+    assert db_client.post("/api/buy", headers=broke, json={"items": [{"item": "pen"}]}).status_code == 200
+
+    info = db_client.get("/api/info", headers=alice).json()
+    assert info["coins"] == 1000 - 10 - 20 - 40 - 10
+    assert info["inventory"] == [{"type": "cup", "quantity": 3}, {"type": "pen", "quantity": 1}]
+    assert len(info["coinHistory"]["sent"]) == 1
+
+
+def test_idempotency_counts_expired_takeovers(db_client, session_factory, monkeypatch):
+    monkeypatch.setattr(idempotency, "store", idempotency.DatabaseStore())
+    alice = auth_headers(db_client, "alice")
+    auth_headers(db_client, "bob")
+    send = {**alice, "Idempotency-Key": "send-1"}
+    db_client.post("/api/sendCoin", headers=send, json={"toUser": "bob", "amount": 10})
+    with session_factory() as db:
+        db.query(models.IdempotencyKey).update({"expires_at": datetime(2020, 1, 1, tzinfo=timezone.utc)})
+        db.commit()
+
+    response = db_client.post("/api/sendCoin", headers=send, json={"toUser": "bob", "amount": 10})
+    assert "Idempotent-Replayed" not in response.headers
+    assert idempotency.store.evictions == 1
+    assert "idempotency_evictions_total 1" in db_client.get("/metrics").text
+    assert db_client.get("/api/info", headers=alice).json()["coins"] == 980
+
+
+def test_idempotency_keys_expire(session_factory):
+    now = datetime(2026, 10, 18, tzinfo=timezone.utc)
+    with session_factory() as db:
+        db.add(models.User(username="alice", password_hash="x", coins=1000))
+        db.commit()
+        user_id = crud.get_user_id(db, "alice")
+        assert crud.claim_idempotency_key(db, user_id, "k", "a", "{}", now, now + timedelta(hours=1))
+        db.commit()
+        later = now + timedelta(hours=2)
+        assert crud.get_idempotent_response(db, user_id, "k", now).live
+        assert not crud.get_idempotent_response(db, user_id, "k", later).live
+        assert not crud.claim_idempotency_key(db, user_id, "k", "b", "{}", now, now + timedelta(hours=1))
+        # an expired key is taken over by the next request
+        assert crud.claim_idempotency_key(db, user_id, "k", "b", "{}", later, later + timedelta(hours=1))
+        db.commit()
+        store = idempotency.DatabaseStore()
+        assert store.purge(db, later) == 0
+        assert store.purge(db, later + timedelta(hours=1)) == 1
+        assert store.evictions == 1
+
+
+def test_idempotency_memory_store_waits_for_in_flight():
+    store = idempotency.MemoryStore(maxsize=1, ttl=60)
+    calls = []
+
+    async def perform():
+        calls.append(len(calls))
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            raise HTTPException(status_code=400, detail="Insufficient funds")
+
+    async def run(key="k", fingerprint="f"):
+        return await store.execute(None, 1, key, fingerprint, {"message": "ok"}, perform)
+
+    async def main():
+        results = await asyncio.gather(run(), run(), run(), return_exceptions=True)
+        # The first attempt failed, the first waiter ran again, the other replayed it
+        assert isinstance(results[0], HTTPException)
+        assert results[1] == {"message": "ok"}
+        assert results[2].headers["Idempotent-Replayed"] == "true"
+        with pytest.raises(HTTPException) as excinfo:
+            await run(fingerprint="other")
+        assert excinfo.value.status_code == 422
+        await run(key="k2")
+
+    asyncio.run(main())
+    assert len(calls) == 3
+    assert store.waits >= 2 and store.replays == 1
+    assert store.evictions == 1 and len(store) == 1